@@ -56,7 +56,8 @@ def new_map(kmap, platform, conditional):
         ]
         if conditional:
             require_setting(binding, "emax_enabled")
-        if binding.get("command") in ["move", "move_to", "emax_move_sexp"]:
+        if binding.get("command") in ["move", "move_to", "emax_move_sexp",
+                                      "emax_up_list", "emax_down_list"]:
             clone = copy.deepcopy(binding)
             require_setting(clone, "setting.emax_region_active")
             add_arg(clone, "extend", True)
@@ -13,20 +13,63 @@ import os
 
 __file__ = os.path.abspath(__file__)
 
+import re
+import threading
+import time
+
+from array import array
+from bisect import bisect_left, bisect_right
 from cStringIO import StringIO
 
-import kill_ring
 import emax_build_keymaps
+from emax_kill_ring import killRing, KillLog
+from emax_sexp import SexpIndex, ScanTimeout
 
 from sublime_plugin import TextCommand, EventListener, WindowCommand
 from sublime import (
     Region, OP_EQUAL, OP_NOT_EQUAL, set_timeout, set_clipboard, get_clipboard,
-    ENCODED_POSITION, HIDDEN, PERSISTENT, #status_message
+    packages_path, windows,
+    ENCODED_POSITION, HIDDEN, PERSISTENT, DRAW_OUTLINED, #status_message
 )
 
 
 REGION_VAR = 'emax_region_active'
 ENABLED_VAR = 'emax_enabled'
+MATCHING_VAR = 'emax_highlight_matching_parens'
+PERSIST_VAR = 'emax_persistent_kill_ring'
+ATOM_SELECTOR = 'string, comment'
+
+
+
+"""
+How long (in seconds) an S-expression command may spend scanning the buffer
+before the rest of the scan is moved to a background thread, so that typing
+isn't held up.
+"""
+
+SCAN_BUDGET = 0.05
+
+
+
+"""
+How big (in characters) a buffer can be and still have its matching brackets
+highlighted.  Bringing a buffer's L{SexpIndex} up to date means reading all of
+its text and its strings and comments, in the main thread, after every edit;
+in bigger buffers that would hold up typing, so they're only indexed when an
+S-expression command is run.
+"""
+
+MATCHING_SIZE_LIMIT = 131072
+
+
+
+"""
+How long (in milliseconds) to wait after a kill before copying it to the
+system clipboard, so that a run of kills (which the kill ring merges into one
+entry) is copied once, at the end.
+"""
+
+CLIPBOARD_DELAY = 100
 
 
 
@@ -72,12 +115,134 @@ class ToggleEmax(TextCommand):
 
 
 
-lastText = {
-    # Mapping of view ID to a string.  Really only for incremental search, but
-    # may collect other small, temporary views like the input buffer if the user
-    # invokes incsearch from there, as there doesn't seem to be an API for
-    # determining which views are "real" and which views are like that.
-}
+class SearchHistory(object):
+    """
+    The strings searched for recently, like Emacs's C{search-ring}: one for
+    every incremental search panel, without duplicates, and only so many.
+
+    Really only for incremental search, but may collect text from other small,
+    temporary views like the input buffer if the user invokes incsearch from
+    there, as there doesn't seem to be an API for determining which views are
+    "real" and which views are like that.
+
+    @ivar maxEntries: the most strings to remember.
+
+    @ivar entries: the strings, least recently used first.
+
+    @ivar position: how far back from the most recent string the last one
+        recalled was, or -1 if none has been recalled since the last search.
+    """
+
+    def __init__(self, maxEntries=32):
+        self.maxEntries = maxEntries
+        self.entries = []
+        self.position = -1
+
+
+    def add(self, text):
+        """
+        Remember a string that was searched for, as the most recent.
+        """
+        if text in self.entries:
+            self.entries.remove(text)
+        self.entries.append(text)
+        del self.entries[:-self.maxEntries]
+        self.position = -1
+
+
+    def latest(self):
+        """
+        The most recent string, or C{None} if there isn't one.
+        """
+        if self.entries:
+            return self.entries[-1]
+        return None
+
+
+    def recall(self, older):
+        """
+        Move to an older (or newer) string, like 'isearch-ring-retreat' (M-p)
+        and 'isearch-ring-advance' (M-n).
+
+        @return: the string, or an empty string when moving past the newest
+            one, or C{None} when there are no more in that direction.
+        """
+        position = self.position + (1 if older else -1)
+        if position >= len(self.entries) or position < -1:
+            return None
+        self.position = position
+        if position == -1:
+            return ""
+        return self.entries[-1 - position]
+
+
+
+"""
+The strings searched for recently, in every window.
+"""
+
+searchHistory = SearchHistory()
+
+
+
+"""
+The IDs of the views known to be incremental search areas, because
+L{EmaxIncrementalSearch} has just shown one or one of the commands bound only
+there has been run in one.  Once there are any, only their text is added to
+L{searchHistory}; other panels (Goto Anything, the console) look much the
+same.
+"""
+
+incSearchViewIDs = set()
+
+
+
+"""
+Whether L{EmaxIncrementalSearch} has just shown the incremental search area,
+so that the next view to be activated is it.
+"""
+
+incSearchOpening = False
+
+
+
+class ViewRegistry(object):
+    """
+    The IDs of the "real" views, the ones in windows' tabs, as opposed to
+    panels and the like; kept up to date by L{EmaxManager}.
+
+    @ivar ids: the IDs, or C{None} until they're first needed, when they're
+        found by looking through every window.
+    @type ids: C{set} of L{int} or L{NoneType}
+    """
+
+    def __init__(self):
+        self.ids = None
+
+
+    def add(self, view):
+        if self.ids is not None:
+            self.ids.add(view.id())
+
+
+    def discard(self, view):
+        if self.ids is not None:
+            self.ids.discard(view.id())
+
+
+    def __contains__(self, view):
+        if self.ids is None:
+            self.ids = set(each.id() for window in windows()
+                           for each in window.views())
+        return view.id() in self.ids
+
+
+
+"""
+The real views, in every window.
+"""
+
+viewRegistry = ViewRegistry()
 
 
 
@@ -88,7 +253,7 @@ def smellsLikeIncSearch(view):
     meet these criteria.
     """
     return (view.window() is not None and
-            view.id() not in [x.id() for x in view.window().views()] and
+            view not in viewRegistry and
             view.size() < 200)
 
 
@@ -100,17 +265,65 @@ class EmaxManager(EventListener):
     want to toggle an 'emax_enabled' globally.
 
     (Also, it observes the state of the incremental-search window, so that
-    EmaxMaybeRestoreIncrementalSearch can work.)
+    EmaxMaybeRestoreIncrementalSearch can work, and keeps track of which views
+    are real, so that it can tell that window apart from them.)
     """
 
     def on_activated(self, view):
+        global incSearchOpening
         update_status(view)
+        if incSearchOpening and smellsLikeIncSearch(view):
+            incSearchViewIDs.add(view.id())
+        incSearchOpening = False
+
+
+    def on_new(self, view):
+        viewRegistry.add(view)
+
+
+    def on_load(self, view):
+        viewRegistry.add(view)
+
+
+    def on_clone(self, view):
+        viewRegistry.add(view)
+
+
+    def on_close(self, view):
+        viewRegistry.discard(view)
+        incSearchViewIDs.discard(view.id())
+        scopeIndexes.pop(view.id(), None)
+        sexpIndexes.pop(view.id(), None)
+        sexpGenerations.pop(view.id(), None)
+        diffIndexes.pop(view.id(), None)
+        markRings.pop(view.id(), None)
+        globalMarkRing.forget(view)
+
+
+    def on_modified(self, view):
+        cancelSexpScan(view)
+
+
+    def on_selection_modified(self, view):
+        cancelSexpScan(view)
+        if EMAX_ENABLED and view.settings().get(MATCHING_VAR, True):
+            if view.size() <= MATCHING_SIZE_LIMIT:
+                highlightMatching(view)
+            else:
+                view.erase_regions("emax_matching")
 
 
     def on_deactivated(self, view):
-        if smellsLikeIncSearch(view):
+        clipboard.flush()
+        # Each index holds a copy of the view's text; only the view being
+        # worked in needs one.
+        cancelSexpScan(view)
+        sexpIndexes.pop(view.id(), None)
+        scopeIndexes.pop(view.id(), None)
+        if view.id() in incSearchViewIDs or (not incSearchViewIDs and
+                                             smellsLikeIncSearch(view)):
             if view.size() > 0:
-                lastText[view.id()] = view.substr(Region(0, view.size()))
+                searchHistory.add(view.substr(Region(0, view.size())))
 
 
     def on_query_context(self, view, key, operator, operand, match_all):
@@ -140,6 +353,21 @@ class EmaxBeep(TextCommand):
 
 
 
+class EmaxIncrementalSearch(WindowCommand):
+    """
+    Show the incremental search area, like 'show_panel' does, and note which
+    view it is once it has focus, so that what's searched for in it can be
+    remembered.
+    """
+
+    def run(self, reverse=False):
+        global incSearchOpening
+        incSearchOpening = True
+        self.window.run_command(
+            "show_panel", {"reverse": reverse, "panel": "incremental_find"})
+
+
+
 # import pydoc
 
 class EmaxMaybeRestoreIncrementalSearch(TextCommand):
@@ -149,10 +377,13 @@ class EmaxMaybeRestoreIncrementalSearch(TextCommand):
     """
 
     def run(self, edit, reverse=False):
+        incSearchViewIDs.add(self.view.id())
         if self.view.size() == 0:
-            if self.view.id() in lastText:
-                self.view.insert(edit, 0, lastText[self.view.id()])
+            text = searchHistory.latest()
+            if text is not None:
+                self.view.insert(edit, 0, text)
         else:
+            searchHistory.add(self.view.substr(Region(0, self.view.size())))
             # Note: command must be run on the *window*: running it on the view
             # runs it on the incsearch view, which apparently does nothing.
             self.view.window().run_command(
@@ -165,6 +396,251 @@ class EmaxMaybeRestoreIncrementalSearch(TextCommand):
 
 
 
+class EmaxRecallIncrementalSearch(TextCommand):
+    """
+    Replace the text in the incremental search area with an older (or newer)
+    string from the search history; like 'M-p' and 'M-n' in isearch.
+    """
+
+    def run(self, edit, older=True):
+        incSearchViewIDs.add(self.view.id())
+        current = self.view.substr(Region(0, self.view.size()))
+        text = searchHistory.recall(older)
+        while text == current:
+            # Don't make the user recall the text that's already there.
+            text = searchHistory.recall(older)
+        if text is not None:
+            self.view.replace(edit, Region(0, self.view.size()), text)
+
+
+
+class ClipboardSync(object):
+    """
+    Keep the system clipboard in step with the kill ring, without writing to it
+    any more than necessary, since that can be slow for big kills.
+
+    Kills are copied to the clipboard a little while after they happen.  The
+    clipboard is read back before every yank, since anything (Sublime's own
+    copy and cut, from a menu or another plugin, as well as other programs) may
+    have changed it, and there's no telling when.
+
+    @ivar known: the text last written to (or read from) the clipboard.
+    @type known: L{unicode} or L{NoneType}
+
+    @ivar pending: whether a write to the clipboard is scheduled.
+    """
+
+    def __init__(self):
+        self.known = None
+        self.pending = False
+
+
+    def killed(self):
+        """
+        Note that the kill ring has changed, and copy its newest entry to the
+        clipboard soon.
+        """
+        if not self.pending:
+            self.pending = True
+            set_timeout(self.flush, CLIPBOARD_DELAY)
+
+
+    def flush(self):
+        """
+        Copy the newest kill to the clipboard now, if it's waiting to be.
+        """
+        if not self.pending:
+            return
+        self.pending = False
+        text = killRing.top()
+        if text is not None and text != self.known:
+            set_clipboard(text)
+            self.known = text
+
+
+    def changed(self):
+        """
+        Check whether something else has been copied since the last kill.
+
+        @return: the clipboard's text if so, otherwise C{None}.
+        """
+        if self.pending:
+            # A kill is about to overwrite the clipboard anyway.
+            return None
+        clip = get_clipboard()
+        if not clip or clip == self.known:
+            return None
+        self.known = clip
+        return clip
+
+
+
+"""
+The state of the system clipboard, as far as E-Max knows.
+"""
+
+clipboard = ClipboardSync()
+
+
+
+class MarkRing(object):
+    """
+    The marks set in a view before the current one, like Emacs's C{mark-ring}.
+
+    Each entry holds one point for each cursor that set the mark, and is kept
+    in the view as a set of regions, under a key of its own, so that Sublime
+    moves it along with the text as the buffer is edited.
+
+    @ivar view: the view.
+
+    @ivar maxEntries: the most entries to keep.
+
+    @ivar slots: which of the keys holds each entry, oldest first.
+    @type slots: L{array} of C{'l'}
+    """
+
+    maxEntries = 16
+
+    def __init__(self, view):
+        self.view = view
+        self.slots = array(b"l")
+
+
+    def _key(self, slot):
+        return "emax_mark_ring_%d" % (slot,)
+
+
+    def _store(self, points):
+        if len(self.slots) >= self.maxEntries:
+            slot = self.slots.pop(0)
+        else:
+            slot = min(set(range(self.maxEntries)) - set(self.slots))
+        self.view.add_regions(self._key(slot), [Region(pt) for pt in points],
+                              "", "", HIDDEN)
+        return slot
+
+
+    def push(self, points):
+        """
+        Add a mark as the most recent entry.
+
+        @param points: the mark's position for each cursor.
+        @type points: C{list} of L{int}
+        """
+        self.slots.append(self._store(points))
+
+
+    def bury(self, points):
+        """
+        Add a mark as the oldest entry, as 'pop-to-mark-command' does with the
+        mark it leaves.
+        """
+        self.slots.insert(0, self._store(points))
+
+
+    def pop(self):
+        """
+        Take the most recent entry off the ring.
+
+        @return: its position for each cursor, or C{None} if the ring is empty.
+        @rtype: C{list} of L{int} or L{NoneType}
+        """
+        if not self.slots:
+            return None
+        key = self._key(self.slots.pop())
+        points = [region.a for region in self.view.get_regions(key)]
+        self.view.erase_regions(key)
+        return points
+
+
+
+markRings = {
+    # Mapping of view ID to a MarkRing.
+}
+
+
+
+def markRing(view):
+    """
+    Get the L{MarkRing} for a view, creating it if necessary.
+
+    @rtype: L{MarkRing}
+    """
+    ring = markRings.get(view.id())
+    if ring is None:
+        ring = markRings[view.id()] = MarkRing(view)
+    return ring
+
+
+
+class GlobalMarkRing(object):
+    """
+    The views that marks have been set in, like Emacs's C{global-mark-ring}:
+    whenever a mark is set in a different view from the last one, where it was
+    set is remembered here, too.
+
+    @ivar maxEntries: the most entries to keep.
+
+    @ivar entries: C{(view, key)} pairs, oldest first, where C{key} names the
+        regions in C{view} that hold the mark's position.
+
+    @ivar counter: used to make up a new key for each entry.
+    """
+
+    maxEntries = 16
+
+    def __init__(self):
+        self.entries = []
+        self.counter = 0
+
+
+    def note(self, view, points):
+        """
+        Remember that a mark was set in a view, unless the last one was set in
+        the same view.
+        """
+        if self.entries and self.entries[-1][0].id() == view.id():
+            return
+        key = "emax_global_mark_%d" % (self.counter,)
+        self.counter += 1
+        view.add_regions(key, [Region(pt) for pt in points], "", "", HIDDEN)
+        self.entries.append((view, key))
+        if len(self.entries) > self.maxEntries:
+            oldView, oldKey = self.entries.pop(0)
+            oldView.erase_regions(oldKey)
+
+
+    def forget(self, view):
+        """
+        Forget the marks set in a view, because it has been closed.
+        """
+        self.entries = [(each, key) for (each, key) in self.entries
+                        if each.id() != view.id()]
+
+
+    def rotate(self):
+        """
+        Move the most recent entry to the oldest end of the ring, as
+        'pop-global-mark' does.
+
+        @return: the entry, or C{None} if there aren't any.
+        """
+        if not self.entries:
+            return None
+        entry = self.entries.pop()
+        self.entries.insert(0, entry)
+        return entry
+
+
+
+"""
+The views that marks have been set in, in every window.
+"""
+
+globalMarkRing = GlobalMarkRing()
+
+
+
 class EmaxHelper(TextCommand):
     """
     Helper command with useful methods.
@@ -179,6 +655,92 @@ class EmaxHelper(TextCommand):
             thunk(area.end())
 
 
+    def replace_regions(self, edit, changes):
+        """
+        Make several changes to the buffer at once, one per cursor, and leave a
+        cursor in each.
+
+        The changes are made from the end of the buffer backwards, so that none
+        of them moves the others, and the selection is set just once, at the
+        end.  A change whose region overlaps an earlier one's isn't made (its
+        cursor goes wherever the earlier one's does), so that no text is
+        replaced twice; unless it only deletes text, in which case whatever the
+        earlier one didn't cover is deleted along with it.
+
+        @param changes: a C{list} of C{(region, text, cursor)} tuples: replace
+            C{region} with C{text}, and leave a cursor C{cursor} characters
+            into it.
+
+        @return: where the text of each change ended up (or the text of the
+            change it was merged into), in the same order.
+        @rtype: C{list} of L{Region}
+        """
+        order = sorted(range(len(changes)),
+                       key=lambda i: (changes[i][0].begin(),
+                                      changes[i][0].end()))
+        regions = [None] * len(changes)
+        # The index of the change each one was made as part of.
+        made = [None] * len(changes)
+        kept = []
+        for i in order:
+            region, text, cursor = changes[i]
+            if kept and region.begin() < regions[kept[-1]].end():
+                last = kept[-1]
+                made[i] = last
+                if not text:
+                    regions[last] = Region(regions[last].begin(),
+                                           max(regions[last].end(),
+                                               region.end()))
+                continue
+            made[i] = i
+            regions[i] = region
+            kept.append(i)
+        placed = [None] * len(changes)
+        delta = 0
+        for i in kept:
+            begin, end = regions[i].begin(), regions[i].end()
+            text = changes[i][1]
+            placed[i] = Region(begin + delta, begin + delta + len(text))
+            delta += len(text) - (end - begin)
+        for i in reversed(kept):
+            self.view.replace(edit, regions[i], changes[i][1])
+        sel = self.view.sel()
+        sel.clear()
+        for i in order:
+            placed[i] = placed[made[i]]
+            sel.add(Region(placed[i].a + changes[made[i]][2]))
+        return placed
+
+
+    def substr_regions(self, regions, gap=256):
+        """
+        Get the text of several regions, reading as little at a time from the
+        view as possible: regions that overlap or are close together are read
+        all at once, and the text sliced up afterwards.
+
+        @param gap: how many characters apart two regions may be and still be
+            read together.
+
+        @return: the text of each region, in the same order.
+        @rtype: C{list} of L{unicode}
+        """
+        groups = []
+        for i in sorted(range(len(regions)), key=lambda i: regions[i].begin()):
+            region = regions[i]
+            if groups and region.begin() <= groups[-1][1] + gap:
+                groups[-1][1] = max(groups[-1][1], region.end())
+                groups[-1][2].append(i)
+            else:
+                groups.append([region.begin(), region.end(), [i]])
+        texts = [None] * len(regions)
+        for begin, end, members in groups:
+            text = self.view.substr(Region(begin, end))
+            for i in members:
+                texts[i] = text[regions[i].begin() - begin:
+                                regions[i].end() - begin]
+        return texts
+
+
     def updateScroll(self, forward=True):
         if forward:
             func = max
@@ -188,19 +750,131 @@ class EmaxHelper(TextCommand):
         self.view.show(pt)
 
 
+    def sexpTargets(self, find, command, args=None):
+        """
+        Find where each selection's point should go, using the view's
+        L{SexpIndex}.
+
+        If finding out takes too long, the buffer is scanned in the background
+        instead, and the command is run again once it has been.
+
+        @param find: a function which takes the index and a point, and returns
+            the point's destination.
+
+        @param command: the name of the command to run again.
+
+        @param args: the arguments to run it with.
+
+        @return: the result of C{find} for each selection, or C{None} if
+            they'll be found in the background.
+        """
+        points = [s.b for s in self.view.sel()]
+        def retry():
+            self.view.run_command(command, args or {})
+        return querySexps(
+            self.view, lambda index: [find(index, pt) for pt in points], retry
+        )
+
+
+    def marked_regions(self):
+        """
+        The region between each selection and its mark, or just the selection
+        if it has no mark, like 'select_to_mark' would select.
+        """
+        marks = self.view.get_regions("mark")
+        regions = list(self.view.sel())
+        for i in range(min(len(marks), len(regions))):
+            regions[i] = regions[i].cover(marks[i])
+        return regions
+
+
+    def persist_kills(self):
+        """
+        If the settings say so, keep the kill ring in a log in the User package
+        from now on, loading whatever was killed in earlier sessions first.
+        This is done the first time the kill ring is used, rather than when the
+        plugin loads.
+        """
+        if killRing.log is None and self.view.settings().get(PERSIST_VAR):
+            killRing.persist(KillLog(os.path.join(packages_path(), "User",
+                                                  "E-Max.kill-ring")))
+
+
+    def kill_key(self):
+        """
+        Identify the current state of the view, so that the kill ring can tell
+        whether a kill continues the one before.
+        """
+        return (self.view.id(), self.view.change_count(),
+                tuple((s.a, s.b) for s in self.view.sel()))
+
+
+    def kill_regions(self, edit, regions, forward=True):
+        """
+        Kill some regions: put their text in the kill ring (merging it with the
+        last kill, if this one continues it) and on the clipboard, and delete
+        them.
+
+        @param forward: whether the regions were killed forward from the
+            cursors, as with 'kill-line', or backward.
+        """
+        pieces = self.substr_regions(regions)
+        if not any(pieces):
+            return
+        self.persist_kills()
+        killRing.kill(pieces, forward, self.kill_key())
+        del pieces
+        self.replace_regions(edit, [(r, "", 0) for r in regions])
+        killRing.continueAt(self.kill_key())
+        clipboard.killed()
+
+
+    def insert_pieces(self, edit, regions, pieces):
+        """
+        Replace some regions with yanked text, giving each its own piece if
+        there's one for each, and otherwise all of them, one per line.  Leave a
+        cursor after each, and remember where they went, for 'yank-pop'.
+        """
+        if len(pieces) != len(regions):
+            pieces = ["\n".join(pieces)] * len(regions)
+        yanked = self.replace_regions(
+            edit, [(region, piece, len(piece))
+                   for (region, piece) in zip(regions, pieces)])
+        self.view.add_regions("emax_yank", yanked, "", "", HIDDEN)
+
+
     def region_active_p(self):
         return self.view.settings().get(REGION_VAR)
 
 
+    def place_mark(self, points):
+        """
+        Make some points the mark, one for each cursor, where Sublime's own
+        'select_to_mark' and 'swap_with_mark' will find them too; or, given no
+        points, remove the mark.
+        """
+        if points:
+            self.view.add_regions("mark", [Region(pt) for pt in points],
+                                  "mark", "dot", HIDDEN | PERSISTENT)
+        else:
+            self.view.erase_regions("mark")
+
+
     def set_mark_command(self):
         """
         Set and activate the mark, like (set-mark-command), usually bound to
-        control-space.
+        control-space.  The old mark, if there was one, goes on the view's
+        L{MarkRing}.
         """
-        # Use the built-in mark ring-ish thing.  This doesn't support an
-        # equivalent to (yank-pop) so I need to move to something else
-        # eventually...
-        self.view.run_command('set_mark')
+        old = self.view.get_regions("mark")
+        if old:
+            markRing(self.view).push([region.a for region in old])
+        points = [s.b for s in self.view.sel()]
+        self.place_mark(points)
+        globalMarkRing.note(self.view, points)
+        self.view.sel().clear()
+        for pt in points:
+            self.view.sel().add(Region(pt))
         self.view.settings().set(REGION_VAR, True)
 
 
@@ -210,10 +884,11 @@ class EmaxHelper(TextCommand):
         bound to C-g, will do.  Note that the context-sensitive behavior of C-g
         is not implemented here, but rather as a function of different C-g
         contexts in the .sublime-keymap files.
+
+        The mark itself stays where it is, as in Emacs, so that C-x C-x can
+        still go back to it.
         """
         self.view.settings().set(REGION_VAR, False)
-        self.view.run_command('clear_bookmarks', dict(name="mark"))
-        # hmm. self.cmd.clear_bookmarks(name="mark") instead?
         regions = [s.b for s in self.view.sel()]
         self.view.sel().clear()
         for r in regions:
@@ -227,10 +902,8 @@ class EmaxOpenLineCommand(EmaxHelper):
     """
 
     def run(self, edit):
-        self.each_point_do(lambda point:
-                           self.view.insert(edit, point, "\n"))
-        self.view.run_command("move",
-                              {"by": "characters", "forward": False})
+        self.replace_regions(edit, [(Region(s.end()), "\n", 0)
+                                    for s in self.view.sel()])
 
 
 
@@ -240,9 +913,14 @@ class EmaxKillRingSave(EmaxHelper):
     """
 
     def run(self, edit):
-        self.view.run_command('add_to_kill_ring', {"forward": False})
+        pieces = self.substr_regions(self.marked_regions())
         self.deactivate_mark()
-        set_clipboard(kill_ring.kill_ring.top())
+        if not any(pieces):
+            return
+        self.persist_kills()
+        killRing.seal()
+        killRing.kill(pieces, False)
+        clipboard.killed()
 
 
 
@@ -252,10 +930,8 @@ class EmaxKillRegionCommand(EmaxHelper):
     """
 
     def run(self, edit):
-        self.view.run_command('delete_to_mark')
-        set_clipboard(kill_ring.kill_ring.top())
+        self.kill_regions(edit, self.marked_regions(), False)
         self.deactivate_mark()
-        set_clipboard(kill_ring.kill_ring.top())
 
 
 
@@ -266,24 +942,62 @@ class EmaxKillLine(EmaxHelper):
 
     def run(self, edit):
         self.deactivate_mark()
-        self.view.run_command(
-            "run_macro_file",
-            {"file": "Packages/Default/Delete to Hard EOL.sublime-macro"}
-        )
-        set_clipboard(kill_ring.kill_ring.top())
+        regions = []
+        for s in self.view.sel():
+            pt = s.b
+            end = self.view.line(pt).b
+            if end == pt:
+                # At the end of the line: kill the newline.
+                end = min(pt + 1, self.view.size())
+            regions.append(Region(pt, end))
+        self.kill_regions(edit, regions)
+
+
+
+_forwardWord = re.compile(r"[\W_]*[^\W_]+", re.UNICODE)
+_backwardWord = re.compile(r"[^\W_]+[\W_]*$", re.UNICODE)
+_word = re.compile(r"[^\W_]+", re.UNICODE)
 
 class EmaxDeleteWord(EmaxHelper):
     """
-    Mimic 'delete-word' also known as 'M-d'.
+    Mimic 'kill-word' also known as 'M-d', or 'backward-kill-word', also known
+    as 'M-DEL'.
     """
 
-    def run(self, edit, **kwargs):
+    chunk = 256
+
+    def word_end(self, pt, forward):
+        """
+        Find the other end of the word after (or before) a given point, reading
+        more and more of the buffer until it's found.
+        """
+        size = self.view.size()
+        chunk = self.chunk
+        while True:
+            if forward:
+                end = min(size, pt + chunk)
+                match = _forwardWord.match(self.view.substr(Region(pt, end)))
+                if match is not None and (match.end() < end - pt or
+                                          end == size):
+                    return pt + match.end()
+                if end == size:
+                    return size
+            else:
+                start = max(0, pt - chunk)
+                match = _backwardWord.search(
+                    self.view.substr(Region(start, pt)))
+                if match is not None and (match.start() > 0 or start == 0):
+                    return start + match.start()
+                if start == 0:
+                    return 0
+            chunk *= 2
+
+
+    def run(self, edit, forward=True):
         self.deactivate_mark()
-        self.view.run_command(
-            "delete_word",
-            kwargs
-        )
-        set_clipboard(kill_ring.kill_ring.top())
+        self.kill_regions(edit, [Region(s.b, self.word_end(s.b, forward))
+                                 for s in self.view.sel()], forward)
+
 
 
 class EmaxYank(EmaxHelper):
@@ -291,11 +1005,16 @@ class EmaxYank(EmaxHelper):
     Mimic 'yank' also known as 'C-y'.
     """
     def run(self, edit):
-        clip = get_clipboard()
-        if kill_ring.kill_ring.top() != clip:
-            kill_ring.kill_ring.seal()
-            kill_ring.kill_ring.push(clip)
-        self.view.run_command("yank")
+        self.persist_kills()
+        clip = clipboard.changed()
+        if clip is not None:
+            # Something else was copied since the last kill.
+            killRing.seal()
+            killRing.kill([clip])
+        pieces = killRing.yank()
+        if pieces is not None:
+            self.insert_pieces(edit, list(self.view.sel()), pieces)
+        killRing.seal()
 
 
 
@@ -309,21 +1028,11 @@ class EmaxYankPop(EmaxHelper):
                                                          'emax_yank_pop'):
             print "Previous command was not a yank."
             return
-        if len(self.view.sel()) != 1:
-            print "Only works with one selection."
+        yanked = self.view.get_regions("emax_yank")
+        pieces = killRing.rotate()
+        if pieces is None or not yanked:
             return
-        pt = self.view.sel()[0].a
-        if pt != self.view.sel()[0].b:
-            print "Only works with an empty selection."
-            return
-        kr = kill_ring.kill_ring
-        if kr.top() is not None:
-            # only works for a single-point selection, but better than nothing.
-            self.view.erase(edit, Region(pt, pt - len(kr.top())))
-        kr.head -= 1
-        kr.head %= kr.limit
-        if kr.top() is not None:
-            self.view.run_command("yank")
+        self.insert_pieces(edit, yanked, pieces)
 
 
 
@@ -361,47 +1070,111 @@ class EmaxTransposeChars(EmaxHelper):
         Completely re-implemented since sublime won't let you transpose
         characters near a word boundary.
         """
-        replace = []
-        for region in self.view.sel():
-            pt = region.b
-            ln = self.view.line(pt)
-            if pt == ln.b:
+        changes = []
+        size = self.view.size()
+        points = [region.b for region in self.view.sel()]
+        # The characters either side of each point, and the one before that,
+        # in case the point is at the end of a line.
+        around = self.substr_regions([Region(max(0, pt - 2), min(size, pt + 1))
+                                      for pt in points])
+        for point, text in zip(points, around):
+            pt = point
+            offset = min(pt, 2)
+            if pt == size or text[offset] == "\n":
                 pt -= 1
-            before = Region(pt, max(0, pt - 1))
-            after = Region(pt, min(self.view.size(), pt + 1))
-            if before != after:
-                replace.append([before, after])
-        for before, after in reversed(sorted(replace)):
-            aftert = self.view.substr(after)
-            beforet = self.view.substr(before)
-            self.view.replace(edit, after, beforet)
-            self.view.replace(edit, before, aftert)
+                offset -= 1
+            if pt < 1 or pt + 1 > size:
+                changes.append((Region(point), "", 0))
+                continue
+            changes.append((Region(pt - 1, pt + 1),
+                            text[offset] + text[offset - 1], 2))
+        self.replace_regions(edit, changes)
 
 
 
 class EmaxTransposeWords(EmaxHelper):
     """
-    Transpose the words surrounding the cursor.
+    Mimic 'transpose-words', also known as 'M-t': drag the word before (or
+    around) each cursor forward past the next C{count} words, or backward past
+    the previous ones if C{count} is negative.
     """
 
-    def run(self, edit):
+    chunk = 256
+
+    def transposition(self, pt, count, window=None):
         """
-        Sublime's word-transposition is close enough; you just have to make the
-        cursor line up with its expectation.
+        Work out how to transpose the words around a point, reading more and
+        more of the buffer around it until enough words have been found.
+
+        @param window: the text within C{chunk} characters of the point, if it
+            has already been read.
+
+        @return: a C{(region, text, cursor)} change, as for
+            L{EmaxHelper.replace_regions}, or C{None} if there aren't enough
+            words to transpose.
         """
-        newsels = []
-        for region in self.view.sel():
-            word = self.view.word(region.b)
-            if region.b == word.a:
-                newsels.append(word.a)
+        size = self.view.size()
+        chunk = self.chunk
+        while True:
+            start = max(0, pt - chunk)
+            end = min(size, pt + chunk)
+            if window is not None:
+                text, window = window, None
             else:
-                newsels.append(word.b)
-        self.view.sel().clear()
-        for i in newsels:
-            self.view.sel().add(Region(i, i))
-        self.view.run_command("transpose")
-        self.view.run_command("move", {"forward": True, "by": "words"})
-        self.view.run_command("move", {"forward": True, "by": "words"})
+                text = self.view.substr(Region(start, end))
+            words = [(match.start() + start, match.end() + start)
+                     for match in _word.finditer(text)]
+            chunk *= 2
+            first = bisect_left([word[0] for word in words], pt) - 1
+            if first < 0:
+                if start > 0:
+                    continue
+                first = 0
+            low, high = sorted([first, first + count])
+            if low < 0 or high >= len(words):
+                if (low < 0 and start > 0) or (high >= len(words)
+                                                and end < size):
+                    continue
+                return None
+            if ((words[low][0] == start and start > 0) or
+                (words[high][1] == end and end < size)):
+                # The window might have cut a word in half.
+                continue
+            span = words[low:high + 1]
+            pieces = [text[a - start:b - start] for (a, b) in span]
+            gaps = [text[b - start:a - start]
+                    for ((_, b), (a, _)) in zip(span, span[1:])]
+            if count > 0:
+                pieces.append(pieces.pop(0))
+                cursor = None
+            else:
+                pieces.insert(0, pieces.pop())
+                cursor = len(pieces[0])
+            replacement = pieces[0] + "".join(gap + piece for (gap, piece)
+                                              in zip(gaps, pieces[1:]))
+            if cursor is None:
+                cursor = len(replacement)
+            return (Region(span[0][0], span[-1][1]), replacement, cursor)
+
+
+    def run(self, edit, count=1):
+        if count == 0:
+            return
+        changes = []
+        size = self.view.size()
+        points = [region.b for region in self.view.sel()]
+        around = self.substr_regions([
+            Region(max(0, pt - self.chunk), min(size, pt + self.chunk))
+            for pt in points
+        ])
+        for pt, window in zip(points, around):
+            change = self.transposition(pt, count, window)
+            if change is None:
+                change = (Region(pt), "", 0)
+            changes.append(change)
+        # Where two cursors' transpositions overlap, only the first is made,
+        # rather than moving the words they share twice.
+        self.replace_regions(edit, changes)
 
 
 
@@ -430,26 +1203,64 @@ class EmaxMarkWholeBuffer(EmaxHelper):
 class CharacterCursor(object):
     """
     Scan through a buffer, one character at a time.
+
+    Characters are read from the view a block at a time, in the direction of
+    the scan, so that scanning across a long stretch of text doesn't take a
+    call to C{substr} for each character.  Each block is twice as long as the
+    one before (up to L{maxBlockSize}), so that long scans take few reads but
+    short ones don't read much more than they need.
+
+    @ivar block: the text most recently read from the view.
+
+    @ivar blockStart: the offset in the view of the beginning of C{block}.
     """
 
+    blockSize = 4096
+    maxBlockSize = 1024 * 1024
+
     def __init__(self, backwards, index, view):
         super(CharacterCursor, self).__init__()
         self.backwards = backwards
         self.index = index
         self.view = view
+        self.size = view.size()
+        self.block = ''
+        self.blockStart = 0
 
 
     def __iter__(self):
         return self
 
 
+    def _read(self):
+        """
+        Read the block of text that C{index} is at the start of (or the end of,
+        when scanning backwards).
+        """
+        if self.backwards:
+            end = self.index + 1
+            start = max(0, end - self.blockSize)
+        else:
+            start = self.index
+            end = min(self.size, start + self.blockSize)
+        self.block = self.view.substr(Region(start, end))
+        self.blockStart = start
+        self.blockSize = min(self.blockSize * 2, self.maxBlockSize)
+
+
     def peek(self):
         """
         Take a peek at the next character, without advancing the cursor.
         """
-        if self.index < 0 or self.index > self.view.size():
+        if self.index < 0 or self.index > self.size:
             return ''
-        return self.view.substr(self.index)
+        if self.index == self.size:
+            return self.view.substr(self.index)
+        offset = self.index - self.blockStart
+        if not 0 <= offset < len(self.block):
+            self._read()
+            offset = self.index - self.blockStart
+        return self.block[offset]
 
 
     def next(self):
@@ -464,44 +1275,6 @@ class CharacterCursor(object):
 
 
 
-class LineCursor(object):
-    """
-    Scan through a buffer, one line at a time.
-    """
-    def __init__(self, backwards, index, view):
-        self.backwards = backwards
-        self.view = view
-        self.region = view.line(index)
-        self.stopped = False
-
-
-    def clone(self, reverse=False):
-        return self.__class__(self.backwards ^ reverse, self.region.a,
-                              self.view)
-
-
-    def __iter__(self):
-        return self
-
-
-    def next(self):
-        if self.stopped:
-            raise StopIteration()
-        result = self.view.substr(self.region)
-        if self.backwards:
-            point = self.region.a - 1
-        else:
-            point = self.region.b + 1
-        oldregion = self.region
-        self.region = self.view.line(point)
-        if (oldregion == self.region or
-            self.region.b >= self.view.size() or
-            self.region.a < 0):
-            self.stopped = True
-        return result
-
-
-
 matches = {
     "[": "]",
     "'": "'",
@@ -593,6 +1366,226 @@ def scanOneSexp(scanner, matcher, rmatcher):
 
 
 
+class ScopeIndex(object):
+    """
+    The regions of a view that match some scope selectors, sorted so that the
+    one around a given point can be found by bisection rather than by looking
+    through all of them.
+
+    The regions for each selector are only asked for the first time they're
+    needed, and are thrown away whenever the view's change count moves on.
+
+    @ivar changeCount: the change count of the view when C{regions} were found.
+
+    @ivar regions: mapping of scope selectors to a C{list} of the
+        L{sublime.Region}s that match them, in order.
+
+    @ivar ends: mapping of scope selectors to a C{list} of the ends of those
+        regions, to bisect.
+    """
+
+    def __init__(self, view):
+        self.view = view
+        self.changeCount = view.change_count()
+        self.regions = {}
+        self.ends = {}
+
+
+    def regionsFor(self, name):
+        """
+        Get the regions that match a given scope selector, as of the view's
+        current change count.
+
+        @rtype: C{list} of L{sublime.Region}
+        """
+        changeCount = self.view.change_count()
+        if changeCount != self.changeCount:
+            self.changeCount = changeCount
+            self.regions.clear()
+            self.ends.clear()
+        if name not in self.regions:
+            regions = self.view.find_by_selector(name)
+            self.regions[name] = regions
+            self.ends[name] = [region.b for region in regions]
+        return self.regions[name]
+
+
+    def around(self, name, point):
+        """
+        Find the first region matching a given scope selector which includes a
+        given point (at either end, or anywhere in between).
+
+        @rtype: L{sublime.Region} or L{NoneType}
+        """
+        regions = self.regionsFor(name)
+        # The regions matching one selector don't overlap, so the first one
+        # that ends at or after the point is the only one that could include
+        # it.
+        i = bisect_left(self.ends[name], point)
+        if i < len(regions) and regions[i].a <= point:
+            return regions[i]
+        return None
+
+
+
+scopeIndexes = {
+    # Mapping of view ID to a ScopeIndex.
+}
+
+
+
+def scopeIndex(view):
+    """
+    Get the L{ScopeIndex} for a view, creating it if necessary.
+
+    @rtype: L{ScopeIndex}
+    """
+    index = scopeIndexes.get(view.id())
+    if index is None:
+        index = scopeIndexes[view.id()] = ScopeIndex(view)
+    return index
+
+
+
+sexpIndexes = {
+    # Mapping of view ID to a 2-tuple of the view's change count and a
+    # SexpIndex of its text at that change count; thrown away when the view
+    # loses focus.
+}
+
+
+
+def _regionBounds(region):
+    return region.begin(), region.end()
+
+
+
+def sexpIndex(view):
+    """
+    Get the L{SexpIndex} for a view, creating it if necessary, and bringing it
+    up to date with any changes made since it was last used.
+
+    The strings and comments found by the view's syntax are treated as atoms,
+    so that the brackets and quotes in them are skipped over.
+
+    @rtype: L{SexpIndex}
+    """
+    changeCount = view.change_count()
+    seen, index = sexpIndexes.get(view.id(), (None, None))
+    if index is None:
+        index = SexpIndex()
+    if seen != changeCount:
+        index.update(view.substr(Region(0, view.size())),
+                     scopeIndex(view).regionsFor(ATOM_SELECTOR), _regionBounds)
+        sexpIndexes[view.id()] = (changeCount, index)
+    return index
+
+
+
+sexpLock = threading.Lock()
+
+sexpGenerations = {
+    # Mapping of view ID to a count of the edits, movements and S-expression
+    # commands in that view; a background scan started for one of them gives
+    # up once the count has moved on.
+}
+
+
+
+def cancelSexpScan(view):
+    """
+    Stop any background scan of a view's L{SexpIndex}, and stop the command
+    that's waiting for it from being run again.
+    """
+    sexpGenerations[view.id()] = sexpGenerations.get(view.id(), 0) + 1
+
+
+
+def _scanInBackground(viewID, index, generation, then):
+    """
+    Scan the rest of a L{SexpIndex} a block at a time (so that the main thread
+    never has to wait long for it) and then call C{then} in the main thread,
+    unless the scan is cancelled first.
+    """
+    while True:
+        with sexpLock:
+            if sexpGenerations.get(viewID) != generation:
+                return
+            if index.frontier >= len(index.text):
+                break
+            index.scan(index.frontier + index.scanBlock)
+    set_timeout(then, 0)
+
+
+
+def querySexps(view, query, retry, budget=SCAN_BUDGET):
+    """
+    Ask a question of a view's L{SexpIndex}, giving up if it takes too long.
+
+    If it does, the rest of the buffer is scanned in a background thread, and
+    C{retry} is called when it's done (by which time the question can be
+    answered straight away), unless the view is changed (or its selection is
+    moved) first.
+
+    @param query: a function which takes the index and answers the question.
+
+    @param retry: a function to call, in the main thread, once the index has
+        been scanned.
+
+    @param budget: how long to try for, in seconds, counting the time taken to
+        bring the index up to date with the view.
+    @type budget: L{float}
+
+    @return: the result of C{query}, or C{None} if it took too long.
+    """
+    with sexpLock:
+        deadline = time.time() + budget
+        index = sexpIndex(view)
+        index.deadline = deadline
+        try:
+            return query(index)
+        except ScanTimeout:
+            pass
+        finally:
+            index.deadline = None
+    cancelSexpScan(view)
+    viewID = view.id()
+    generation = sexpGenerations[viewID]
+    changeCount = view.change_count()
+    def finished():
+        if (sexpGenerations.get(viewID) == generation and
+            view.change_count() == changeCount):
+            retry()
+    worker = threading.Thread(target=_scanInBackground,
+                              args=(viewID, index, generation, finished))
+    worker.daemon = True
+    worker.start()
+    return None
+
+
+
+def highlightMatching(view):
+    """
+    Outline the brackets matching those next to each empty selection.
+    """
+    points = [s.b for s in view.sel() if s.empty()]
+    pairs = querySexps(view,
+                       lambda index: [index.matching(pt) for pt in points],
+                       lambda: highlightMatching(view))
+    if pairs is None:
+        return
+    regions = []
+    for pair in pairs:
+        if pair is not None:
+            regions.extend(Region(at, at + 1) for at in pair)
+    if regions:
+        view.add_regions("emax_matching", regions, "comment", "",
+                         DRAW_OUTLINED)
+    else:
+        view.erase_regions("emax_matching")
+
+
+
 class EmaxMoveSexp(EmaxHelper):
     """
     Move the cursor forward or backward by one S-expression.
@@ -610,16 +1603,28 @@ class EmaxMoveSexp(EmaxHelper):
             rmatcher = matches
             backward = True
             adjust = 2
-        for s in self.view.sel():
-            cursor = CharacterCursor(backward, s.b - backward, self.view)
-            if scanOneSexp(cursor, matcher, rmatcher):
-                if extend:
-                    a = s.a
-                else:
-                    a = cursor.index + adjust
-                ns.append(Region(a, cursor.index + adjust))
-            else:
+        if forward:
+            find = SexpIndex.forward
+        else:
+            find = SexpIndex.backward
+        targets = self.sexpTargets(find, "emax_move_sexp",
+                                   dict(forward=forward, extend=extend))
+        if targets is None:
+            return
+        for s, target in zip(self.view.sel(), targets):
+            if target is NotImplemented:
+                # Within a string; the index doesn't know about the brackets
+                # there, so scan for them.
+                cursor = CharacterCursor(backward, s.b - backward, self.view)
+                target = None
+                if scanOneSexp(cursor, matcher, rmatcher):
+                    target = cursor.index + adjust
+            if target is None:
                 ns.append(s)
+            elif extend:
+                ns.append(Region(s.a, target))
+            else:
+                ns.append(Region(target, target))
         self.view.sel().clear()
         for r in ns:
             self.view.sel().add(r)
@@ -627,6 +1632,101 @@ class EmaxMoveSexp(EmaxHelper):
 
 
 
+class EmaxUpList(EmaxHelper):
+    """
+    Mimic 'backward-up-list', also known as 'C-M-u'.
+    """
+
+    def run(self, edit, extend=False):
+        targets = self.sexpTargets(SexpIndex.up, "emax_up_list",
+                                   dict(extend=extend))
+        if targets is None:
+            return
+        ns = []
+        for s, target in zip(self.view.sel(), targets):
+            if target is None:
+                ns.append(s)
+            elif extend:
+                ns.append(Region(s.a, target))
+            else:
+                ns.append(Region(target, target))
+        self.view.sel().clear()
+        for r in ns:
+            self.view.sel().add(r)
+        self.updateScroll(False)
+
+
+
+class EmaxDownList(EmaxHelper):
+    """
+    Mimic 'down-list', also known as 'C-M-d'.
+    """
+
+    def run(self, edit, extend=False):
+        targets = self.sexpTargets(SexpIndex.down, "emax_down_list",
+                                   dict(extend=extend))
+        if targets is None:
+            return
+        ns = []
+        for s, target in zip(self.view.sel(), targets):
+            if target is None:
+                ns.append(s)
+            elif extend:
+                ns.append(Region(s.a, target))
+            else:
+                ns.append(Region(target, target))
+        self.view.sel().clear()
+        for r in ns:
+            self.view.sel().add(r)
+        self.updateScroll()
+
+
+
+class EmaxKillSexp(EmaxHelper):
+    """
+    Mimic 'kill-sexp', also known as 'C-M-k'.
+    """
+
+    def run(self, edit):
+        ends = self.sexpTargets(SexpIndex.forward, "emax_kill_sexp")
+        if ends is None:
+            return
+        self.deactivate_mark()
+        kills = []
+        for s, end in zip(self.view.sel(), ends):
+            if end is None or end is NotImplemented:
+                # Nothing to kill, but the cursor has to be kept.
+                end = s.b
+            kills.append(Region(s.b, end))
+        self.kill_regions(edit, kills)
+
+
+
+class EmaxMarkSexp(EmaxHelper):
+    """
+    Mimic 'mark-sexp', also known as 'C-M-SPC': set the mark at the end of the
+    next S-expression, leaving the point where it is.
+    """
+
+    def run(self, edit):
+        ends = self.sexpTargets(SexpIndex.forward, "emax_mark_sexp")
+        if ends is None:
+            return
+        points = []
+        for s, end in zip(self.view.sel(), ends):
+            if end is None or end is NotImplemented:
+                end = s.b
+            points.append((end, s.b))
+        self.view.sel().clear()
+        for end, point in points:
+            self.view.sel().add(Region(end, end))
+        self.set_mark_command()
+        self.view.sel().clear()
+        for end, point in points:
+            self.view.sel().add(Region(end, point))
+
+
+
 class EmaxSaveAndClose(EmaxHelper):
     """
     Save and close in one command.
@@ -643,6 +1743,120 @@ class EmaxSaveAndClose(EmaxHelper):
 
 
 
+_hunkHeader = re.compile(r"@@ -\S+ \+(\d+)")
+
+class DiffIndex(object):
+    """
+    The files and hunks in a unified diff, and where each line of it ends up.
+
+    Lines are numbered from 0 within the diff, but from 1 within the files it
+    changes, as hunk headers number them.
+
+    @ivar files: the name of each new file, in order.
+
+    @ivar fileLines: the line on which the header for each of C{files} (the
+        C{---} line) is.
+    @type fileLines: L{array.array}
+
+    @ivar hunkLines: the line on which each hunk's header is, in order.
+    @type hunkLines: L{array.array}
+
+    @ivar hunkStarts: the line in the new file at which each hunk starts.
+    @type hunkStarts: L{array.array}
+
+    @ivar hunkFiles: the index in C{files} of the file each hunk changes, or -1
+        if it doesn't say.
+    @type hunkFiles: L{array.array}
+
+    @ivar newLines: for each line of the diff, how many lines up to and
+        including it are context or added lines; that is, lines in the new
+        files.
+    @type newLines: L{array.array}
+    """
+
+    def __init__(self, text):
+        self.files = []
+        self.fileLines = array(b"l")
+        self.hunkLines = array(b"l")
+        self.hunkStarts = array(b"l")
+        self.hunkFiles = array(b"l")
+        self.newLines = array(b"l")
+        count = 0
+        previous = ""
+        for number, line in enumerate(text.split("\n")):
+            if line.startswith("+++ ") and previous.startswith("--- "):
+                self.files.append(line[4:].split("\t")[0])
+                self.fileLines.append(number - 1)
+            elif line.startswith("@@"):
+                match = _hunkHeader.match(line)
+                if match is not None:
+                    self.hunkLines.append(number)
+                    self.hunkStarts.append(int(match.group(1)))
+                    self.hunkFiles.append(len(self.files) - 1)
+            elif line.startswith(" ") or line.startswith("+"):
+                count += 1
+            self.newLines.append(count)
+            previous = line
+
+
+    def target(self, line):
+        """
+        Find the line in a changed file which corresponds to a given line of
+        the diff.
+
+        @return: the name of the file, and the number of the line in it; or
+            C{None} if C{line} isn't in a hunk of a named file.
+        @rtype: 2-C{tuple} of L{unicode} and L{int}, or L{NoneType}
+        """
+        hunk = bisect_right(self.hunkLines, line) - 1
+        if hunk < 0 or self.hunkFiles[hunk] < 0:
+            return None
+        header = self.hunkLines[hunk]
+        offset = self.newLines[line] - self.newLines[header] - 1
+        return (self.files[self.hunkFiles[hunk]],
+                self.hunkStarts[hunk] + offset)
+
+
+    def following(self, lines, line, forward=True):
+        """
+        Find the next (or previous) line in a list of lines, such as
+        C{hunkLines} or C{fileLines}.
+
+        @return: the line, or C{None} if there isn't one.
+        """
+        if forward:
+            i = bisect_right(lines, line)
+        else:
+            i = bisect_left(lines, line) - 1
+        if 0 <= i < len(lines):
+            return lines[i]
+        return None
+
+
+
+diffIndexes = {
+    # Mapping of view ID to a 2-tuple of the view's change count and a
+    # DiffIndex of its text at that change count.
+}
+
+
+
+def diffIndex(view):
+    """
+    Get the L{DiffIndex} for a view, parsing it again if it has changed since
+    it was last used.
+
+    @rtype: L{DiffIndex}
+    """
+    changeCount = view.change_count()
+    seen, index = diffIndexes.get(view.id(), (None, None))
+    if seen != changeCount:
+        index = DiffIndex(view.substr(Region(0, view.size())))
+        diffIndexes[view.id()] = (changeCount, index)
+    return index
+
+
+
 class EmaxJumpToHunk(EmaxHelper):
     """
     Jump to a hunk of a diff.
@@ -653,36 +1867,62 @@ class EmaxJumpToHunk(EmaxHelper):
         Based on the current position of the cursor, jump to the appropriate
         file/line combination.
         """
-        offt = -1
-        havehunk = False
-        for line in LineCursor(True, self.view.sel()[0].b, self.view):
-            if line.startswith("@@"):
-                if havehunk:
-                    continue
-                havehunk = True
-                atat, minus, plus, atat = line.split()
-                baseline = int(plus[1:].split(",")[0])
-                realline = baseline + offt
-            elif line.startswith("+++"):
-                fname = line[4:].split("\t")[0]
-                # definitely set by now, but ugh
-                self.view.window().open_file(
-                    # This should probably try multiple locations, looking for
-                    # files which actually exist, since a shell command like
-                    # "foo | subl" always puts the output into a buffer in /tmp,
-                    # and we can no longer tell which folder it applies to.
-                    os.path.join(
-                        self.view.window().folders()[0], fname
-                    ) + ":" + str(realline),
-                    ENCODED_POSITION
-                )
-                break
-            elif not havehunk and line.startswith(" ") or line.startswith("+"):
-                offt += 1
-            elif line.startswith("-"):
-                pass
-        else:
+        row = self.view.rowcol(self.view.sel()[0].b)[0]
+        target = diffIndex(self.view).target(row)
+        if target is None:
             print "No hunk found."
+            return
+        fname, realline = target
+        self.view.window().open_file(
+            # This should probably try multiple locations, looking for files
+            # which actually exist, since a shell command like "foo | subl"
+            # always puts the output into a buffer in /tmp, and we can no
+            # longer tell which folder it applies to.
+            os.path.join(
+                self.view.window().folders()[0], fname
+            ) + ":" + str(realline),
+            ENCODED_POSITION
+        )
+
+
+
+class EmaxNextHunk(EmaxHelper):
+    """
+    Move to the header of the next (or previous) hunk of a diff, like
+    'diff-hunk-next' (M-n) and 'diff-hunk-prev' (M-p).
+    """
+
+    def run(self, edit, forward=True):
+        self.moveToLine(diffIndex(self.view).hunkLines, forward,
+                        "No more hunks.")
+
+
+    def moveToLine(self, lines, forward, failure):
+        """
+        Move the cursor to the beginning of the next (or previous) one of a
+        list of lines of the diff.
+        """
+        row = self.view.rowcol(self.view.sel()[0].b)[0]
+        line = diffIndex(self.view).following(lines, row, forward)
+        if line is None:
+            print failure
+            return
+        pt = self.view.text_point(line, 0)
+        self.view.sel().clear()
+        self.view.sel().add(Region(pt, pt))
+        self.view.show(pt)
+
+
+
+class EmaxNextFile(EmaxNextHunk):
+    """
+    Move to the next (or previous) file in a diff, like 'diff-file-next' (M-})
+    and 'diff-file-prev' (M-{).
+    """
+
+    def run(self, edit, forward=True):
+        self.moveToLine(diffIndex(self.view).fileLines, forward,
+                        "No more files.")
 
 
 
@@ -695,23 +1935,70 @@ class EmaxExchangePointAndMark(EmaxHelper):
         """
         Exchange the point and the mark.
         """
-        marks = self.view.get_regions("mark")
-        newsel = []
-        newmark = []
-        for s in self.view.sel():
-            for mark in marks:
-                if mark.a == mark.b == s.a:
-                    newsel.append(Region(s.b, s.a))
-                    newmark.append(Region(s.b, s.b))
-        if newsel:
-            self.view.erase_regions("mark")
-            self.view.add_regions(
-                "mark", newmark, "mark", "dot", HIDDEN | PERSISTENT
-            )
-            self.view.sel().clear()
-            for reg in newsel:
-                self.view.sel().add(reg)
-            self.updateScroll()
+        marks = [region.a for region in self.view.get_regions("mark")]
+        selections = list(self.view.sel())
+        if len(marks) != len(selections):
+            # Only the selections that start at a mark can be paired up with
+            # one.
+            anchors = set(marks)
+            selections = [s for s in selections if s.a in anchors]
+            marks = [s.a for s in selections]
+        if not selections:
+            return
+        self.place_mark([s.b for s in selections])
+        self.view.sel().clear()
+        for s, mark in zip(selections, marks):
+            self.view.sel().add(Region(s.b, mark))
+        self.view.settings().set(REGION_VAR, True)
+        self.updateScroll()
+
+
+
+class EmaxPopMark(EmaxHelper):
+    """
+    Replication of 'pop-to-mark-command', i.e. C-u C-SPC: jump to the mark, and
+    take the next one off the mark ring, putting this one at the other end.
+    """
+
+    def run(self, edit):
+        ring = markRing(self.view)
+        target = [region.a for region in self.view.get_regions("mark")]
+        if not target:
+            # The ring ran out last time, taking the mark with it; the marks
+            # popped since were buried at the other end.
+            target = ring.pop()
+            if target is None:
+                return
+        self.place_mark(ring.pop())
+        ring.bury(target)
+        self.view.settings().set(REGION_VAR, False)
+        self.view.sel().clear()
+        for pt in target:
+            self.view.sel().add(Region(pt))
+        self.updateScroll()
+
+
+
+class EmaxPopGlobalMark(WindowCommand):
+    """
+    Replication of 'pop-global-mark', i.e. C-x C-SPC: go back to the view where
+    a mark was last set, and to that mark.
+    """
+
+    def run(self):
+        entry = globalMarkRing.rotate()
+        if entry is None:
+            return
+        view, key = entry
+        marks = view.get_regions(key)
+        window = view.window()
+        if window is None or not marks:
+            return
+        window.focus_view(view)
+        view.sel().clear()
+        for mark in marks:
+            view.sel().add(Region(mark.a))
+        view.show(marks[0])
 
 
 
@@ -733,10 +2020,11 @@ def overlapping(view, point, scopeNames):
     @return: a region that spans one of the named scopes.
     @rtype: L{sublime.Region} or L{NoneType}
     """
+    index = scopeIndex(view)
     for name in scopeNames:
-        for region in view.find_by_selector(name):
-            if region.a <= point <= region.b:
-                return region
+        region = index.around(name, point)
+        if region is not None:
+            return region
 
 
 
@@ -752,6 +2040,9 @@ class EmaxFillParagraph(TextCommand):
     def run(self, edit):
         """
         Fill a paragraph around the first point.
+
+        Every selection (not just the first) is carried through the wrapping,
+        so multiple cursors and an active region survive it.
         """
         scopes = self.view.scope_name(self.view.sel()[0].a).split()
         desired = set([
@@ -760,28 +2051,52 @@ class EmaxFillParagraph(TextCommand):
         ])
 
         if desired.intersection(set(scopes)):
-            from epywrap import wrapPythonDocstring
+            from epywrap import wrapPythonDocstringPoints, lineEdits
             orig = self.view.sel()[0]
             scope = overlapping(self.view, orig.a, desired)
             startline = self.view.substr(self.view.line(scope.a))
             indentation = startline[:len(startline) - len(startline.lstrip())]
             torepl = Region(scope.a + 3, scope.b - 3)
-            origPoint = orig.a - torepl.a
+            origPoints = []
+            for s in self.view.sel():
+                origPoints.extend([s.a, s.b])
             io = StringIO()
             origText = self.view.substr(torepl)
             lineLength = self.view.settings().get("wrap_width")
             if not lineLength:
                 lineLength = 79
-            newPoint = wrapPythonDocstring(
-               origText, io, indentation, point=origPoint, width=lineLength
-            ) + torepl.a
+            newPoints = iter(wrapPythonDocstringPoints(
+               origText, io, indentation, width=lineLength,
+               points=[pt - torepl.a for pt in origPoints
+                       if torepl.a <= pt <= torepl.b]
+            ))
             val = io.getvalue()
             if val != origText:
-                self.view.replace(edit, torepl, val)
-                # try to put the selection back at least vaguely where it was.
+                # Only touch the lines that changed, from the bottom up so that
+                # the earlier offsets stay valid; this keeps the undo history
+                # (and the redraw) proportional to the change.
+                for start, end, text in reversed(lineEdits(origText, val)):
+                    if start == end:
+                        self.view.insert(edit, torepl.a + start, text)
+                    else:
+                        self.view.replace(
+                            edit, Region(torepl.a + start, torepl.a + end), text
+                        )
+                # try to put the selections back at least vaguely where they
+                # were.
+                delta = len(val) - len(origText)
+                mapped = []
+                for pt in origPoints:
+                    if pt < torepl.a:
+                        mapped.append(pt)
+                    elif pt > torepl.b:
+                        mapped.append(pt + delta)
+                    else:
+                        mapped.append(next(newPoints) + torepl.a)
                 self.view.sel().clear()
-                self.view.sel().add(Region(newPoint, newPoint))
-                self.view.show(newPoint)
+                for i in range(0, len(mapped), 2):
+                    self.view.sel().add(Region(mapped[i], mapped[i + 1]))
+                self.view.show(mapped[1])
         else:
             # this should _really_ be accomplished via a mapping context, but I
             # cannot figure out for the life of me how selector matching in
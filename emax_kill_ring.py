@@ -0,0 +1,419 @@
+# Copyright (C) 2012
+# See LICENSE.txt for details.
+
+"""
+E-Max's own kill ring.
+
+This doesn't depend on Sublime, and nothing here knows about views; the kill
+commands in L{emax_commands} read and delete the text, and tell the ring about
+it.
+"""
+
+from __future__ import unicode_literals
+
+import os
+import zlib
+import struct
+import threading
+
+__all__ = [
+    "KillRing",
+    "KillLog",
+    "killRing",
+]
+
+
+
+class _Kill(object):
+    """
+    One entry in a L{KillRing}: the text killed at each of several cursors,
+    kept as UTF-8, and compressed if there's a lot of it.
+
+    @ivar data: the pieces of text, encoded as UTF-8 and joined together.
+    @type data: L{bytes}
+
+    @ivar lengths: the length of each piece, in bytes.
+    @type lengths: C{tuple} of L{int}
+
+    @ivar compressed: whether C{data} is compressed with L{zlib}.
+    """
+
+    __slots__ = ("data", "lengths", "compressed")
+
+    def __init__(self, pieces, compressAbove):
+        encoded = [piece.encode("utf-8") for piece in pieces]
+        self.lengths = tuple(len(each) for each in encoded)
+        data = b"".join(encoded)
+        del encoded
+        self.compressed = len(data) > compressAbove
+        if self.compressed:
+            data = zlib.compress(data, 1)
+        self.data = data
+
+
+    @classmethod
+    def _fromData(cls, data, lengths, compressed):
+        kill = cls.__new__(cls)
+        kill.data = data
+        kill.lengths = lengths
+        kill.compressed = compressed
+        return kill
+
+
+    def size(self):
+        """
+        How much memory this kill takes, in bytes (more or less).
+        """
+        return len(self.data)
+
+
+    def pieces(self):
+        """
+        Get the pieces of text back.
+
+        @rtype: C{list} of L{unicode}
+        """
+        data = self.data
+        if self.compressed:
+            data = zlib.decompress(data)
+        pieces = []
+        start = 0
+        for length in self.lengths:
+            pieces.append(data[start:start + length].decode("utf-8"))
+            start += length
+        return pieces
+
+
+
+class KillLog(object):
+    """
+    An append-only file recording the entries of a L{KillRing}, so that they
+    can be loaded again in a later session.
+
+    Each record is a header giving its kind, whether its data is compressed,
+    how many pieces it has and how long its data is, followed by the length of
+    each piece and then the data, all just as a L{_Kill} keeps them.  A record
+    either adds a new entry or replaces the newest one (when a kill was merged
+    into it).
+
+    Since merged kills are written out again in full, the file grows faster
+    than the ring does; every so often it is rewritten, in a background thread,
+    with just the ring's current entries.
+
+    @ivar path: the file's name.
+
+    @ivar records: how many records are in the file.
+
+    @ivar size: how long the file is, in bytes.
+
+    @ivar lock: held while appending to the file, or replacing it.
+    """
+
+    _header = struct.Struct(b"<cBII")
+    _length = struct.Struct(b"<I")
+
+    NEW = b"n"
+    REPLACE = b"r"
+
+    def __init__(self, path):
+        self.path = path
+        self.records = 0
+        self.size = 0
+        self.lock = threading.Lock()
+        self._backlog = None
+
+
+    def _encode(self, kind, kill):
+        return b"".join(
+            [self._header.pack(kind, kill.compressed, len(kill.lengths),
+                               len(kill.data))]
+            + [self._length.pack(length) for length in kill.lengths]
+            + [kill.data])
+
+
+    def load(self):
+        """
+        Read the entries recorded in the file, if there is one.  Anything after
+        the last complete record (left there by a crash, say) is cut off.
+
+        @return: the entries, oldest first.
+        @rtype: C{list} of L{_Kill}
+        """
+        try:
+            f = open(self.path, "rb")
+        except IOError:
+            return []
+        try:
+            data = f.read()
+        finally:
+            f.close()
+        entries = []
+        offset = 0
+        records = 0
+        while offset + self._header.size <= len(data):
+            kind, compressed, count, dataLength = self._header.unpack_from(
+                data, offset)
+            start = offset + self._header.size + count * self._length.size
+            end = start + dataLength
+            if kind not in (self.NEW, self.REPLACE) or end > len(data):
+                break
+            lengths = struct.unpack_from(b"<%dI" % (count,), data,
+                                         offset + self._header.size)
+            if kind == self.REPLACE and entries:
+                entries.pop()
+            entries.append(_Kill._fromData(data[start:end], lengths,
+                                           bool(compressed)))
+            offset = end
+            records += 1
+        del data
+        if offset != os.path.getsize(self.path):
+            f = open(self.path, "r+b")
+            try:
+                f.truncate(offset)
+            finally:
+                f.close()
+        self.records = records
+        self.size = offset
+        return entries
+
+
+    def append(self, kill, replace=False):
+        """
+        Record a new entry.
+
+        @param replace: whether it replaces the newest entry recorded so far.
+        """
+        record = self._encode(self.REPLACE if replace else self.NEW, kill)
+        with self.lock:
+            try:
+                f = open(self.path, "ab")
+                try:
+                    f.write(record)
+                finally:
+                    f.close()
+            except IOError, e:
+                # Not being able to save a kill shouldn't stop it happening.
+                print "Could not write to the kill ring log:", e
+                return
+            self.records += 1
+            self.size += len(record)
+            if self._backlog is not None:
+                self._backlog.append(record)
+
+
+    def compact(self, entries):
+        """
+        Rewrite the file in a background thread, so that it holds just the
+        given entries (and anything appended while that's happening).
+
+        @param entries: the entries, oldest first.  They're written out as they
+            are now, so the caller may go on changing the list.
+        """
+        if self._backlog is not None:
+            return
+        entries = list(entries)
+        self._backlog = []
+        thread = threading.Thread(target=self._compact, args=(entries,))
+        thread.daemon = True
+        thread.start()
+
+
+    def _compact(self, entries):
+        temporary = self.path + ".new"
+        try:
+            f = open(temporary, "wb")
+            try:
+                for kill in entries:
+                    f.write(self._encode(self.NEW, kill))
+                with self.lock:
+                    backlog = self._backlog
+                    for record in backlog:
+                        f.write(record)
+                    f.close()
+                    if os.name == "nt":
+                        # rename() won't replace an existing file here.
+                        os.remove(self.path)
+                    os.rename(temporary, self.path)
+                    self.records = len(entries) + len(backlog)
+                    self.size = os.path.getsize(self.path)
+            finally:
+                f.close()
+        finally:
+            self._backlog = None
+
+
+
+class KillRing(object):
+    """
+    A bounded ring of killed text, like Emacs's C{kill-ring}.
+
+    Each entry holds one piece of text for each cursor that killed it, so that
+    yanking with the same number of cursors gives each its own piece back.
+
+    Consecutive kills are merged into one entry, the way C{C-k C-k} kills two
+    lines in Emacs: L{kill} says where the kill happened, and if it's where the
+    last one left off (as given to L{continueAt}) the text is added to the
+    newest entry instead of starting a new one.
+
+    @ivar maxEntries: the most entries to keep.
+
+    @ivar maxBytes: the most memory to use for entries (apart from the newest
+        one, which is always kept).
+
+    @ivar compressAbove: entries larger than this many bytes are compressed.
+
+    @ivar entries: the L{_Kill}s, oldest first.
+
+    @ivar size: the total size of C{entries}, in bytes.
+
+    @ivar yankIndex: how far back from the newest entry the last yank came
+        from.
+
+    @ivar log: where the entries are kept between sessions, if anywhere.
+    @type log: L{KillLog} or L{NoneType}
+    """
+
+    def __init__(self, maxEntries=60, maxBytes=16 * 1024 * 1024,
+                 compressAbove=64 * 1024):
+        self.maxEntries = maxEntries
+        self.maxBytes = maxBytes
+        self.compressAbove = compressAbove
+        self.entries = []
+        self.size = 0
+        self.yankIndex = 0
+        self.log = None
+        self._continuation = None
+
+
+    def __len__(self):
+        return len(self.entries)
+
+
+    def persist(self, log):
+        """
+        Keep the entries in a log from now on, starting with the ones it
+        already has from earlier sessions (which go before any in the ring
+        now).
+
+        @type log: L{KillLog}
+        """
+        current = self.entries
+        self.entries = []
+        self.size = 0
+        for kill in log.load() + current:
+            self._push(kill)
+        self.log = log
+        for kill in current:
+            log.append(kill)
+        self.yankIndex = 0
+
+
+    def _push(self, kill):
+        self.entries.append(kill)
+        self.size += kill.size()
+        while len(self.entries) > 1 and (len(self.entries) > self.maxEntries
+                                         or self.size > self.maxBytes):
+            self.size -= self.entries.pop(0).size()
+
+
+    def kill(self, pieces, forward=True, key=None):
+        """
+        Add some killed text to the ring.
+
+        @param pieces: the text killed at each cursor, in order.
+        @type pieces: C{list} of L{unicode}
+
+        @param forward: whether the text was killed forward from the cursors
+            (so that, if merged, it goes after the newest entry's text) or
+            backward (so it goes before).
+
+        @param key: something identifying the state of the buffer before the
+            kill; if it's equal to the last key given to L{continueAt}, this
+            kill continues the last one.
+        """
+        pieces = list(pieces)
+        merged = False
+        if (key is not None and key == self._continuation and self.entries
+            and len(self.entries[-1].lengths) == len(pieces)):
+            last = self.entries.pop()
+            self.size -= last.size()
+            old = last.pieces()
+            del last
+            merged = True
+            if forward:
+                pieces = [a + b for (a, b) in zip(old, pieces)]
+            else:
+                pieces = [b + a for (a, b) in zip(old, pieces)]
+            del old
+        self._continuation = None
+        kill = _Kill(pieces, self.compressAbove)
+        del pieces
+        self._push(kill)
+        self.yankIndex = 0
+        if self.log is not None:
+            self.log.append(kill, merged)
+            if (self.log.records > 2 * self.maxEntries
+                or self.log.size > 2 * self.maxBytes):
+                self.log.compact(self.entries)
+
+
+    def continueAt(self, key):
+        """
+        Note the state of the buffer just after a kill, so that a kill made in
+        that same state will be merged with it.
+        """
+        self._continuation = key
+
+
+    def seal(self):
+        """
+        Make sure that the next kill starts a new entry.
+        """
+        self._continuation = None
+
+
+    def yank(self):
+        """
+        Get the newest entry, for yanking.
+
+        @return: the text killed at each cursor, or C{None} if the ring is
+            empty.
+        @rtype: C{list} of L{unicode} or L{NoneType}
+        """
+        self.yankIndex = 0
+        if not self.entries:
+            return None
+        return self.entries[-1].pieces()
+
+
+    def rotate(self):
+        """
+        Move on to the entry before the last one yanked (wrapping around from
+        the oldest to the newest), for 'yank-pop'.
+
+        @return: as for L{yank}.
+        """
+        if not self.entries:
+            return None
+        self.yankIndex = (self.yankIndex + 1) % len(self.entries)
+        return self.entries[-1 - self.yankIndex].pieces()
+
+
+    def top(self):
+        """
+        Get the text of the newest entry, with the pieces for each cursor on
+        separate lines, as it would be put on the clipboard.
+
+        @rtype: L{unicode} or L{NoneType}
+        """
+        if not self.entries:
+            return None
+        return "\n".join(self.entries[-1].pieces())
+
+
+
+"""
+The kill ring shared by every view.
+"""
+
+killRing = KillRing()
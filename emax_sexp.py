@@ -0,0 +1,588 @@
+# Copyright (C) 2012
+# See LICENSE.txt for details.
+
+"""
+An index of the brackets and strings in a buffer, for moving by S-expressions
+without scanning the text again on every keystroke.
+
+This doesn't depend on Sublime; L{emax_commands} keeps a L{SexpIndex} for each
+view and feeds it the view's text, along with the regions that the view's
+syntax says are strings or comments.
+"""
+
+from __future__ import unicode_literals
+
+import re
+import time
+from array import array
+from bisect import bisect_left, bisect_right
+
+__all__ = [
+    "SexpIndex",
+    "ScanTimeout",
+]
+
+
+
+OPENERS = {
+    "(": ")",
+    "[": "]",
+    "{": "}",
+}
+
+CLOSERS = dict((close, open) for (open, close) in OPENERS.items())
+
+QUOTES = "'\""
+
+DELIMITERS = frozenset(list(OPENERS) + list(CLOSERS) + list(QUOTES))
+
+_code = re.compile(r"""[][(){}'"]""")
+_inQuotes = dict((quote, re.compile(r"[\\\n%s]" % (quote,)))
+                 for quote in QUOTES)
+_word = re.compile(r"""[^][(){}'"\s]*""", re.UNICODE)
+_notSpace = re.compile(r"\S", re.UNICODE)
+
+
+
+def _firstDifference(old, new, block):
+    """
+    Find the first index at which two sequences differ, comparing them a block
+    at a time so that long identical stretches are compared quickly.
+
+    @return: the index, or C{None} if they're the same.
+    """
+    if old == new:
+        return None
+    common = min(len(old), len(new))
+    start = 0
+    while (start < common and
+           old[start:start + block] == new[start:start + block]):
+        start += block
+    end = min(start + block, common)
+    while start < end and old[start] == new[start]:
+        start += 1
+    return start
+
+
+
+class ScanTimeout(Exception):
+    """
+    A L{SexpIndex} would have had to go on scanning past its C{deadline} to
+    answer a question.  What it scanned before giving up is kept, so asking
+    again will pick up where it left off.
+    """
+
+
+
+class SexpIndex(object):
+    """
+    The matching brackets and quotes in some text.
+
+    The text is scanned lazily, only as far as it needs to be to answer the
+    questions asked of it so far, and the state of the scan is saved every so
+    often (every L{checkpointInterval} characters or so).  When the text
+    changes, the scan picks up again from the last checkpoint before the first
+    change, so after a small edit only the text between there and wherever the
+    next question is about gets scanned again.
+
+    Some spans of the text may be given as I{atoms}: whole strings and
+    comments, as a syntax highlighter sees them.  Each of those is skipped in
+    one step, as a single S-expression, no matter what brackets or quotes are
+    in it.  Atoms are only looked at as the scan (or a question) reaches them,
+    and when the text changes only those from the line of the first change on
+    are looked at again; like a syntax highlighter, this assumes that a change
+    to a line can't change the atoms before it.
+
+    Elsewhere, a string runs from a quote to the next matching quote that isn't
+    escaped by a backslash, or to the end of the line if there isn't one.
+    Brackets within strings don't count.  A closing bracket which doesn't match
+    the innermost open one is left unmatched.
+
+    @ivar text: the text.
+
+    @ivar atomStarts: the beginning of each atom looked at so far, in order.
+    @type atomStarts: L{array.array}
+
+    @ivar atomEnds: the end of each of those atoms, in the same order.
+    @type atomEnds: L{array.array}
+
+    @ivar frontier: how far into C{text} has been scanned.
+
+    @ivar stack: the offsets of the brackets, quotes and atoms which are still
+        open at C{frontier}, innermost last.
+
+    @ivar closeFor: mapping of the offsets of brackets, quotes and atoms which
+        have been closed to the offsets of the characters that close them (for
+        an atom, its last character).
+
+    @ivar closes: the offsets of those closing characters, in order.
+    @type closes: L{array.array}
+
+    @ivar opens: the offsets of the characters they close, in the same order as
+        C{closes}.
+    @type opens: L{array.array}
+
+    @ivar strays: the offsets of closing brackets that don't close anything, in
+        order.
+    @type strays: L{array.array}
+
+    @ivar checkpoints: the offsets at which the scan was saved, in order.
+    @type checkpoints: L{array.array}
+
+    @ivar stacks: the C{stack} at each of C{checkpoints}.
+
+    @ivar deadline: if not C{None}, the time (as returned by L{time.time})
+        after which scanning stops, with L{ScanTimeout}.
+    """
+
+    checkpointInterval = 4096
+    compareBlock = 65536
+    scanBlock = 65536
+    deadline = None
+
+    def __init__(self, text="", atoms=(), bounds=tuple):
+        self.text = text
+        self.atomStarts = array(b"l")
+        self.atomEnds = array(b"l")
+        self._setAtoms(atoms, bounds)
+        self.frontier = 0
+        self.stack = []
+        self.closeFor = {}
+        self.closes = array(b"l")
+        self.opens = array(b"l")
+        self.strays = array(b"l")
+        self.checkpoints = array(b"l", [0])
+        self.stacks = [()]
+
+
+    def _setAtoms(self, atoms, bounds):
+        """
+        Replace the atoms that haven't been looked at yet.
+
+        @param atoms: the atoms, in order; they must not overlap.  Those that
+            end before the last one in C{atomEnds} are assumed to be the ones
+            already there.
+        @type atoms: a sequence
+
+        @param bounds: a function which takes an element of C{atoms} and
+            returns its beginning and end.
+        """
+        after = self.atomEnds[-1] if self.atomEnds else -1
+        low, high = 0, len(atoms)
+        while low < high:
+            middle = (low + high) // 2
+            if bounds(atoms[middle])[1] <= after:
+                low = middle + 1
+            else:
+                high = middle
+        self._atomSource = atoms
+        self._atomBounds = bounds
+        self._atomNext = low
+        self._peekAtom()
+
+
+    def _peekAtom(self):
+        """
+        Note where the next atom that hasn't been looked at yet begins.
+        """
+        if self._atomNext < len(self._atomSource):
+            self._nextStart = self._atomBounds(
+                self._atomSource[self._atomNext])[0]
+        else:
+            self._nextStart = None
+
+
+    def _convertAtoms(self, until, patient=False):
+        """
+        Look at every atom beginning before a given offset, adding it to
+        C{atomStarts} and C{atomEnds}.
+
+        @param patient: if true, carry on past C{deadline}; for use in the
+            middle of a scan, which mustn't be interrupted.
+
+        @raise ScanTimeout: if C{deadline} passes first.
+        """
+        if self._nextStart is None or self._nextStart >= until:
+            return
+        source = self._atomSource
+        bounds = self._atomBounds
+        starts = self.atomStarts
+        ends = self.atomEnds
+        i = self._atomNext
+        try:
+            while i < len(source):
+                start, end = bounds(source[i])
+                if start >= until:
+                    break
+                i += 1
+                if end > start and (not ends or start >= ends[-1]):
+                    starts.append(start)
+                    ends.append(end)
+                if (not i % 4096 and not patient and
+                    self.deadline is not None and time.time() > self.deadline):
+                    raise ScanTimeout()
+        finally:
+            self._atomNext = i
+            self._peekAtom()
+
+
+    def _atomAt(self, offset, patient=False):
+        """
+        Find the end of the atom beginning at a given offset.
+
+        @param patient: as for L{_convertAtoms}.
+
+        @return: the end, or C{None} if no atom begins there.
+        """
+        self._convertAtoms(offset + 1, patient)
+        i = bisect_left(self.atomStarts, offset)
+        if i < len(self.atomStarts) and self.atomStarts[i] == offset:
+            return self.atomEnds[i]
+        return None
+
+
+    def _atomEndingAt(self, offset):
+        """
+        Find the beginning of the atom ending at a given offset.
+
+        @return: the beginning, or C{None} if no atom ends there.
+        """
+        self._convertAtoms(offset)
+        i = bisect_left(self.atomEnds, offset)
+        if i < len(self.atomEnds) and self.atomEnds[i] == offset:
+            return self.atomStarts[i]
+        return None
+
+
+    def update(self, text, atoms=(), bounds=tuple):
+        """
+        Replace the text and atoms, throwing away only the parts of the scan
+        after the first difference (or the beginning of its line).
+
+        @param atoms: as for L{_setAtoms}.
+
+        @param bounds: as for L{_setAtoms}.
+        """
+        change = _firstDifference(self.text, text, self.compareBlock)
+        if change is not None:
+            change = text.rfind("\n", 0, change) + 1
+            kept = bisect_left(self.atomEnds, change)
+            if kept < len(self.atomStarts):
+                change = min(change, self.atomStarts[kept])
+            del self.atomStarts[kept:]
+            del self.atomEnds[kept:]
+        self.text = text
+        self._setAtoms(atoms, bounds)
+        if change is not None:
+            self.rewind(change)
+
+
+    def rewind(self, offset):
+        """
+        Forget everything that was learned by scanning at or after the given
+        offset, going back to the last checkpoint before it.
+        """
+        if offset >= self.frontier:
+            return
+        i = bisect_right(self.checkpoints, offset) - 1
+        start = self.checkpoints[i]
+        del self.checkpoints[i + 1:]
+        del self.stacks[i + 1:]
+        self.frontier = start
+        self.stack = list(self.stacks[i])
+        j = bisect_left(self.closes, start)
+        for opener in self.opens[j:]:
+            del self.closeFor[opener]
+        del self.closes[j:]
+        del self.opens[j:]
+        del self.strays[bisect_left(self.strays, start):]
+
+
+    def _nextAtom(self, offset, patient=False):
+        """
+        Find the first atom beginning at or after a given offset.
+
+        @param patient: as for L{_convertAtoms}.
+
+        @return: the beginning and end of the atom, or the length of the text
+            and C{None} if there isn't one.
+        """
+        self._convertAtoms(offset + 1, patient)
+        starts = self.atomStarts
+        i = bisect_left(starts, offset)
+        while i == len(starts) and self._nextStart is not None:
+            self._convertAtoms(self._nextStart + 1, patient)
+        if i < len(starts):
+            return starts[i], self.atomEnds[i]
+        return len(self.text), None
+
+
+    def _advance(self, pos, stack, limit, record):
+        """
+        Scan from a given offset up to (but not past) another.
+
+        @param pos: the offset to scan from.
+
+        @param stack: the brackets, quotes and atoms open at C{pos}; this is
+            updated in place.
+
+        @param limit: the offset to scan up to.
+
+        @param record: if true, note the brackets, strings and atoms that are
+            found, and save checkpoints along the way.
+
+        @return: the offset that the scan got to, which may be just past
+            C{limit} if it ended on an escaped character.
+        """
+        text = self.text
+        nextCheckpoint = self.checkpoints[-1] + self.checkpointInterval
+        nextAtom, nextAtomEnd = self._nextAtom(pos, True)
+        # Nothing is ever opened inside an atom, so only the innermost thing
+        # open can be one; this is its end, if it is.
+        atomEnd = None
+        if stack:
+            atomEnd = self._atomAt(stack[-1], True)
+        while pos < limit:
+            if atomEnd is not None:
+                if atomEnd > limit:
+                    return limit
+                opener = stack.pop()
+                if record:
+                    self.closeFor[opener] = atomEnd - 1
+                    self.closes.append(atomEnd - 1)
+                    self.opens.append(opener)
+                pos = atomEnd
+                atomEnd = None
+                nextAtom, nextAtomEnd = self._nextAtom(pos, True)
+            elif stack and text[stack[-1]] in QUOTES:
+                match = _inQuotes[text[stack[-1]]].search(text, pos, limit)
+                if match is None:
+                    return limit
+                at = match.start()
+                c = text[at]
+                if c == "\\":
+                    pos = at + 2
+                    continue
+                opener = stack.pop()
+                if c != "\n" and record:
+                    self.closeFor[opener] = at
+                    self.closes.append(at)
+                    self.opens.append(opener)
+                pos = at + 1
+            else:
+                if nextAtom < pos:
+                    nextAtom, nextAtomEnd = self._nextAtom(pos, True)
+                match = _code.search(text, pos, min(limit, nextAtom))
+                if match is None:
+                    if nextAtom < limit:
+                        stack.append(nextAtom)
+                        atomEnd = nextAtomEnd
+                        pos = nextAtom
+                        continue
+                    pos = limit
+                else:
+                    at = match.start()
+                    c = text[at]
+                    pos = at + 1
+                    if c in CLOSERS:
+                        if stack and text[stack[-1]] == CLOSERS[c]:
+                            opener = stack.pop()
+                            if record:
+                                self.closeFor[opener] = at
+                                self.closes.append(at)
+                                self.opens.append(opener)
+                        elif record:
+                            self.strays.append(at)
+                    else:
+                        stack.append(at)
+                if record and pos >= nextCheckpoint and not (
+                        stack and text[stack[-1]] in QUOTES):
+                    self.checkpoints.append(pos)
+                    self.stacks.append(tuple(stack))
+                    nextCheckpoint = pos + self.checkpointInterval
+        return pos
+
+
+    def scan(self, until=None):
+        """
+        Make sure the text has been scanned up to a given offset.
+
+        @param until: the offset, or C{None} for the end of the text.
+
+        @raise ScanTimeout: if C{deadline} passes first.
+        """
+        if until is None or until > len(self.text):
+            until = len(self.text)
+        while self.frontier < until:
+            if self.deadline is not None and time.time() > self.deadline:
+                raise ScanTimeout()
+            limit = min(until, self.frontier + self.scanBlock)
+            # Look at the atoms first, since the scan itself can't be
+            # interrupted.
+            self._convertAtoms(limit + 1)
+            self.frontier = self._advance(self.frontier, self.stack, limit,
+                                          True)
+
+
+    def stackAt(self, offset):
+        """
+        Find the brackets, quotes and atoms that are open at a given offset.
+
+        @return: their offsets, innermost last.
+        @rtype: C{list} of L{int}
+        """
+        self.scan(offset)
+        i = bisect_right(self.checkpoints, offset) - 1
+        stack = list(self.stacks[i])
+        self._advance(self.checkpoints[i], stack, offset, False)
+        return stack
+
+
+    def partner(self, offset):
+        """
+        Find the character matching the bracket or quote at a given offset, or
+        the other end of the atom beginning or ending there.
+
+        @return: the offset of the matching character, or C{None} if there
+            isn't one (including if the character at C{offset} is within a
+            string, and so doesn't count).
+        @rtype: L{int} or L{NoneType}
+        """
+        if not 0 <= offset < len(self.text):
+            return None
+        self.scan(offset + 1)
+        if offset in self.closeFor:
+            return self.closeFor[offset]
+        i = bisect_left(self.closes, offset)
+        if i < len(self.closes) and self.closes[i] == offset:
+            return self.opens[i]
+        while offset in self.stack and self.frontier < len(self.text):
+            # Still open; look further.
+            self.scan(self.frontier + self.scanBlock)
+        return self.closeFor.get(offset)
+
+
+    def forward(self, point):
+        """
+        Find the end of the S-expression after a given point.
+
+        @return: the end of that S-expression; C{None} if there isn't one
+            (because the point is at the end of a list or string, or before an
+            unmatched bracket); or C{NotImplemented} if the point is before a
+            bracket within a string or comment, which this index knows nothing
+            about.
+        """
+        text = self.text
+        match = _notSpace.search(text, point)
+        if match is None:
+            return None
+        at = match.start()
+        end = self._atomAt(at)
+        if end is not None:
+            return end
+        c = text[at]
+        if c not in DELIMITERS:
+            return min(_word.match(text, at).end(), self._nextAtom(at)[0])
+        partner = self.partner(at)
+        if partner is not None and partner > at:
+            return partner + 1
+        if c in OPENERS and at not in self.stackAt(at + 1):
+            return NotImplemented
+        return None
+
+
+    def backward(self, point):
+        """
+        Find the beginning of the S-expression before a given point.
+
+        @return: as for L{forward}.
+        """
+        text = self.text
+        at = point - 1
+        while (at >= 0 and text[at].isspace() and
+               self._atomEndingAt(at + 1) is None):
+            at -= 1
+        if at < 0:
+            return None
+        start = self._atomEndingAt(at + 1)
+        if start is not None:
+            return start
+        c = text[at]
+        if c not in DELIMITERS:
+            while (at >= 0 and text[at] not in DELIMITERS and
+                   not text[at].isspace() and
+                   self._atomEndingAt(at + 1) is None):
+                at -= 1
+            return at + 1
+        partner = self.partner(at)
+        if partner is not None and partner < at:
+            return partner
+        if c in CLOSERS:
+            i = bisect_left(self.strays, at)
+            if i == len(self.strays) or self.strays[i] != at:
+                return NotImplemented
+        return None
+
+
+    def up(self, point):
+        """
+        Find the beginning of the innermost list (or string, or atom) around a
+        given point.
+
+        @rtype: L{int} or L{NoneType}
+        """
+        stack = self.stackAt(point)
+        if stack:
+            return stack[-1]
+        return None
+
+
+    def down(self, point):
+        """
+        Find the point just inside the next list after a given point, without
+        leaving the current one.
+
+        @rtype: L{int} or L{NoneType}
+        """
+        text = self.text
+        pos = point
+        while True:
+            nextAtom, nextAtomEnd = self._nextAtom(pos)
+            match = _code.search(text, pos, nextAtom)
+            if match is None:
+                if nextAtomEnd is None:
+                    return None
+                pos = nextAtomEnd
+                continue
+            at = match.start()
+            partner = self.partner(at)
+            if partner is None or partner < at:
+                # A close (or an unmatched open): no list to go down into.
+                if text[at] in OPENERS or text[at] in QUOTES:
+                    pos = at + 1
+                    continue
+                return None
+            if text[at] in OPENERS:
+                return at + 1
+            # Skip over strings.
+            pos = partner + 1
+
+
+    def matching(self, point):
+        """
+        Find a pair of matching brackets touching a given point: one just after
+        it, or else one just before it.
+
+        @return: the offsets of the two brackets, in order, or C{None}.
+        @rtype: 2-C{tuple} of L{int} or L{NoneType}
+        """
+        text = self.text
+        if point < len(text) and text[point] in OPENERS:
+            partner = self.partner(point)
+            if partner is not None:
+                return (point, partner)
+        if point > 0 and text[point - 1] in CLOSERS:
+            partner = self.partner(point - 1)
+            if partner is not None:
+                return (partner, point - 1)
+        return None
@@ -15,32 +15,88 @@ Twisted project U{http://twistedmatrix.com/}.
 Currently (obviously) the only supported editor is U{Sublime Text 2
 <http://www.sublimetext.com/>} but a sufficiently enterprising individual could
 either use this file as a script (no dependencies!) by piping the contents of
-the docstring to it, or call L{wrapPythonDocstring} and preserve point position.
+the docstring to it, or call L{wrapPythonDocstring} and preserve point position
+(or L{wrapPythonDocstringPoints}, to preserve several of them).
+
+Given the names of files or directories, the script instead wraps every
+docstring in every Python source file it finds there, in place, using a pool of
+processes.  Or, to save starting it afresh for each docstring, it can be left
+running as a server, answering JSON requests on its standard input.
 """
 
 from __future__ import unicode_literals
 
+import hashlib
+import json
+import os
 import re
-from uuid import uuid4
+import shutil
+import tempfile
+import tokenize
+from bisect import bisect_left, bisect_right
+from difflib import SequenceMatcher
+from itertools import chain
+from io import StringIO
 
 __all__ = [
-    "wrapPythonDocstring"
+    "wrapPythonDocstring",
+    "wrapPythonDocstringPoints",
+    "iterWrappedDocstring",
+    "checkPythonDocstring",
+    "lineEdits",
 ]
 
 
 
+"""
+Identifies the wrapping rules implemented by this module, so that L{WrapCache}
+can tell that what it remembers is out of date.  Increase it whenever a change
+here changes the wrapped output for any docstring.
+"""
+
+WRAPPER_VERSION = 1
+
+
+
+_underline = re.compile("(?:=+|-+)$")
+
 def isUnderline(expr):
-    return bool(re.match("[=]+$", expr) or re.match("[-]+$", expr))
+    return bool(_underline.match(expr))
 
 def startslist(x):
     return (x == '-' or (x.endswith(".") and x[:-1].isdigit()))
 
+# Shared by every paragraph that doesn't have any words or points (yet).
+_noWords = []
+_noPoints = {}
+_sentenceEnds = (".", "?", "!")
+
 class RegularParagraph(object):
+    """
+    A paragraph of text, to be filled.
+
+    There is one of these for every paragraph of every docstring, so they're
+    kept small: C{__slots__} instead of a C{__dict__}, and C{points} is only
+    allocated for a paragraph which has a point in it.
+
+    @ivar words: the words of the paragraph.  The first line added becomes this
+        list, rather than being copied into it.
+    @type words: C{list} of L{unicode}
+
+    @ivar points: C{None}, or a mapping of indexes into C{words} to C{list}s of
+        2-tuples of C{(offsetInWord, pointIndex)}.
+    """
+
+    __slots__ = ("words", "points", "fixedIndent", "hangIndent",
+                 "followIndent", "more", "pointTracker", "_unwrappedLines",
+                 "_headingType", "_headingPoints")
+
     otherIndent = ""
 
     def __init__(self, pointTracker, fixedIndent="", hangIndent="",
                  followIndent=""):
-        self.words = []
+        self.words = _noWords
+        self.points = None
         self.fixedIndent = fixedIndent
         self.hangIndent = hangIndent
         self.followIndent = followIndent
@@ -48,7 +104,7 @@ class RegularParagraph(object):
         self.pointTracker = pointTracker
         self._unwrappedLines = 0
         self._headingType = None
-        self._headingPoints = []
+        self._headingPoints = ()
 
 
     def matchesTag(self, other):
@@ -75,22 +131,63 @@ class RegularParagraph(object):
         return bool(self._headingType)
 
 
-    def add(self, line):
-        clean = self.pointTracker.peek(line)
-        stripped = clean.strip()
+    def extend(self, words, marks):
+        """
+        Add some words to the end of this paragraph, along with the points that
+        L{PointTracker.tokenize} found among them.
+
+        A point which was not within (or directly after) a word on its line
+        sticks to the end of the last word already in this paragraph or, if
+        there isn't one, to the beginning of the next word to come along.
+        """
+        base = len(self.words)
+        tracker = self.pointTracker
+        if (marks or tracker.pending) and self.points is None:
+            self.points = {}
+        if words and tracker.pending:
+            self.points.setdefault(base, []).extend(
+                (0, pointIndex) for pointIndex in tracker.pending
+            )
+            del tracker.pending[:]
+        for wordIndex, inWord, pointIndex in marks:
+            if wordIndex >= 0:
+                where = (base + wordIndex, inWord)
+            elif self.words:
+                where = (base - 1, len(self.words[-1]))
+            elif words:
+                where = (base, 0)
+            else:
+                tracker.pending.append(pointIndex)
+                continue
+            self.points.setdefault(where[0], []).append((where[1], pointIndex))
+        if self.words is _noWords:
+            # The list is always a fresh one from PointTracker.tokenize, so
+            # there's no need to copy it.
+            self.words = words
+        else:
+            self.words.extend(words)
+
+
+    def add(self, line, offset):
+        # Everything below looks only at the words, so that each line is only
+        # scanned once, by tokenize().
+        words, marks = self.pointTracker.tokenize(line, offset)
 
-        if stripped:
+        if words:
             self._unwrappedLines += 1
             active = self
-            firstword = list(self.pointTracker.filterWords(line.split()))[0]
-            if stripped.startswith("@"):
+            firstword = words[0]
+            if firstword.startswith("@"):
                 fp = FieldParagraph(pointTracker=self.pointTracker)
-                fp.words.extend(line.split())
+                fp.extend(words, marks)
                 active = self.more = fp
-            elif isUnderline(stripped) and self._unwrappedLines == 2:
+            elif (len(words) == 1 and isUnderline(firstword) and
+                  self._unwrappedLines == 2):
                 # This paragraph is actually a section heading.
-                active.setIsHeading(stripped[0])
-                self._headingPoints = self.pointTracker.extractPoints(line)
+                active.setIsHeading(firstword[0])
+                self._headingPoints = [pointIndex
+                                       for (wordIndex, inWord, pointIndex)
+                                       in marks]
                 # FIXME: should respect leading indentation.
                 active = self.nextRegular()
             elif startslist(firstword):
@@ -99,7 +196,7 @@ class RegularParagraph(object):
                 LIST_INDENT = 4
                 # FIXME: this also needs to respect leading indentation so it
                 # can properly represent nested lists.
-                hangIndent = self.pointTracker.lengthOf(firstword) + 1
+                hangIndent = len(firstword) + 1
                 fi = self.fixedIndent
                 if not (self.words and startslist(self.words[0])):
                     fi += (" " * LIST_INDENT)
@@ -109,22 +206,20 @@ class RegularParagraph(object):
                     hangIndent=" " * hangIndent,
                     followIndent=self.followIndent,
                 )
-                fp.words.extend(line.split())
+                fp.extend(words, marks)
                 active = self.more = fp
             else:
-                self.words.extend(line.split())
-            if stripped.endswith("::"):
+                self.extend(words, marks)
+            if words[-1].endswith("::"):
                 active.more = PreFormattedParagraph(
                     active,
-                    indentBegins=len(clean) - len(clean.lstrip())
+                    indentBegins=len(line) - len(line.lstrip())
                 )
                 active = active.more
             return active
         else:
-            rawstrip = line.strip()
-            if rawstrip:
-                self.words.append(rawstrip)
-            if len(list(self.pointTracker.filterWords(self.words))):
+            self.extend(words, marks)
+            if self.words:
                 return self.nextRegular()
         return self
 
@@ -132,19 +227,19 @@ class RegularParagraph(object):
     def wrap(self, output, indentation, width):
         if not self.words:
             return
-        thisLine = self.firstIndent(indentation)
+        tracker = self.pointTracker
+        points = self.points or _noPoints
+        thisLine = [self.firstIndent(indentation)]
+        lineLength = len(thisLine[0])
+        linePoints = []
         first = True
         prevWord = ''
-        for word in self.words:
-            if not self.pointTracker.isWord(word):
-                thisLine += word
-                continue
-            if ((prevWord.endswith(".") or prevWord.endswith("?") or
-                 prevWord.endswith("!")) and not prevWord[:-1].isdigit()):
+        for index, word in enumerate(self.words):
+            if (prevWord.endswith(_sentenceEnds) and
+                not prevWord[:-1].isdigit()):
                 words = prevWord.split(".")[:-1]
                 if ( len(words) > 1 and
-                     [self.pointTracker.lengthOf(x) for x in words] ==
-                     [1] * len(words) ):
+                     [len(x) for x in words] == [1] * len(words) ):
                     # acronym
                     spaces = 1
                 else:
@@ -152,27 +247,31 @@ class RegularParagraph(object):
             else:
                 spaces = 1
             prevWord = word
-            if ( self.pointTracker.lengthOf(thisLine) +
-                 self.pointTracker.lengthOf(word) + spaces <= width ):
+            if lineLength + len(word) + spaces <= width:
                 if first:
                     first = not first
                 else:
-                    thisLine += (" " * spaces)
-                thisLine += word
+                    thisLine.append(" " * spaces)
+                    lineLength += spaces
             else:
-                output.write(self.pointTracker.scan(thisLine, output.tell()))
-                output.write("\n")
-                thisLine = self.restIndent(indentation) + word
-        output.write(self.pointTracker.scan(thisLine, output.tell()))
-        output.write("\n")
+                tracker.writeLine(output, thisLine, linePoints)
+                thisLine = [self.restIndent(indentation)]
+                lineLength = len(thisLine[0])
+                linePoints = []
+            if index in points:
+                for inWord, pointIndex in points[index]:
+                    linePoints.append((lineLength + inWord, pointIndex))
+            thisLine.append(word)
+            lineLength += len(word)
+        tracker.writeLine(output, thisLine, linePoints)
         if self.isHeading():
             indentText = self.firstIndent(indentation)
-            lineSize = self.pointTracker.lengthOf(thisLine) - len(indentText)
-            output.write(self.pointTracker.scan(
-                indentText + ''.join(self._headingPoints) +
-                (self._headingType * lineSize), output.tell()
-            ))
-            output.write("\n")
+            lineSize = lineLength - len(indentText)
+            tracker.writeLine(
+                output, [indentText, self._headingType * lineSize],
+                [(len(indentText), pointIndex)
+                 for pointIndex in self._headingPoints]
+            )
 
 
     def firstIndent(self, indentation):
@@ -202,6 +301,8 @@ class RegularParagraph(object):
 
 class FieldParagraph(RegularParagraph):
 
+    __slots__ = ()
+
     otherIndent = "    "
 
     def nextIndent(self):
@@ -210,8 +311,8 @@ class FieldParagraph(RegularParagraph):
 
     def matchesTag(self, other):
         if isinstance(other, FieldParagraph):
-            myWords = list(self.pointTracker.filterWords(self.words))
-            theirWords = list(self.pointTracker.filterWords(other.words))
+            myWords = self.words
+            theirWords = other.words
             if ( set([myWords[0], theirWords[0]]) ==
                  set(["@return:", "@rtype:"]) ):
                  # matching @return and @rtype fields.
@@ -227,8 +328,12 @@ class FieldParagraph(RegularParagraph):
 
 class PreFormattedParagraph(object):
 
+    __slots__ = ("lines", "points", "before", "indentBegins", "fixedIndent",
+                 "more", "pointTracker", "_leadingPoints", "_trailingPoints")
+
     def __init__(self, before, indentBegins):
         self.lines = []
+        self.points = {}
         self.before = before
 
         pointTracker = before.pointTracker
@@ -240,126 +345,192 @@ class PreFormattedParagraph(object):
         self.fixedIndent = fixedIndent
         self.more = None
         self.pointTracker = pointTracker
+        self._leadingPoints = []
+        self._trailingPoints = []
 
 
     def matchesTag(self, other):
         return False
 
 
-    def add(self, line):
-        actualLine = self.pointTracker.peek(line)
-
-        if actualLine.strip():
-            if len(actualLine) - len(actualLine.lstrip()) <= self.indentBegins:
+    def add(self, line, offset):
+        tracker = self.pointTracker
+        if line.strip():
+            if len(line) - len(line.lstrip()) <= self.indentBegins:
                 next = self.more = self.before.genRegular()
-                return next.add(line)
-            self.lines.append(line.rstrip())
+                return next.add(line, offset)
+            line = line.rstrip()
+            found = [(min(inLine, len(line)), pointIndex)
+                     for (inLine, pointIndex) in tracker.pointsIn(line, offset)]
+            if tracker.pending:
+                found.extend((len(line) - len(line.lstrip()), pointIndex)
+                             for pointIndex in tracker.pending)
+                del tracker.pending[:]
+            self.lines.append(line)
         else:
-            self.lines.append(line.strip())
+            found = [(0, pointIndex)
+                     for (inLine, pointIndex) in tracker.pointsIn(line, offset)]
+            self.lines.append("")
+        if found:
+            self.points[len(self.lines) - 1] = found
         return self
 
 
     def fixIndentation(self):
-        while self.lines and not self.lines[0].strip():
-            self.lines.pop(0)
-        while self.lines and not self.lines[-1].strip():
-            self.lines.pop()
-        if not self.lines:
-            return
-        cleanLines = map(self.pointTracker.peek, self.lines)
-        commonLeadingIndent = min([len(x) - len(x.lstrip()) for x in cleanLines
-                                   if x.strip()])
-        newLines = []
-        for actualLine, line in zip(cleanLines, self.lines):
-            if actualLine != line and line[:commonLeadingIndent].strip():
-                # There's a marker, and it's in the leading whitespace.
-                # Explicitly reposition the marker at the beginning of the fixed
-                # indentation.
-                line = (self.pointTracker.marker +
-                        actualLine[commonLeadingIndent:])
+        lines = self.lines
+        first = 0
+        while first < len(lines) and not lines[first]:
+            first += 1
+        last = len(lines)
+        while last > first and not lines[last - 1]:
+            last -= 1
+        points = {}
+        for index, found in self.points.items():
+            pointIndexes = [pointIndex for (inLine, pointIndex) in found]
+            if index < first:
+                self._leadingPoints.extend(pointIndexes)
+            elif index >= last:
+                self._trailingPoints.extend(pointIndexes)
             else:
-                line = line.rstrip()[commonLeadingIndent:]
-            newLines.append(line)
-        self.lines = newLines
+                points[index - first] = found
+        lines = lines[first:last]
+        if lines:
+            commonLeadingIndent = min([len(x) - len(x.lstrip())
+                                       for x in lines if x])
+            self.lines = [line[commonLeadingIndent:] for line in lines]
+            self.points = dict(
+                (index, [(max(0, inLine - commonLeadingIndent), pointIndex)
+                         for (inLine, pointIndex) in found])
+                for (index, found) in points.items()
+            )
+        else:
+            self.lines = []
+            self.points = {}
 
 
     def wrap(self, output, indentation, width):
         # OK, now we know about all the lines we're going to know about.
         self.fixIndentation()
-        for line in self.lines:
-            if self.pointTracker.peek(line):
-                output.write(indentation + "    " + self.fixedIndent)
-            output.write(self.pointTracker.scan(line, output.tell()))
-            output.write("\n")
+        tracker = self.pointTracker
+        tracker.place(output.tell(), self._leadingPoints)
+        prefix = indentation + "    " + self.fixedIndent
+        for index, line in enumerate(self.lines):
+            found = self.points.get(index, ())
+            if line:
+                tracker.writeLine(output, [prefix, line],
+                                  [(len(prefix) + inLine, pointIndex)
+                                   for (inLine, pointIndex) in found])
+            else:
+                tracker.writeLine(output, [], found)
+        tracker.place(output.tell(), self._trailingPoints)
+
+
+
+_nonWhitespace = re.compile(r"\S+", re.UNICODE)
 
 
 
 class PointTracker(object):
     """
     Object for keeping track of where the insertion points are.
+
+    Points are never embedded in the text being wrapped.  Each one is kept as
+    an integer offset: first into the original docstring, then relative to the
+    word (or preformatted line) that it was found in, and finally, once that
+    word has been written, into the output.
     """
 
-    def __init__(self, point):
-        self.point = point
-        self.marker = "{" + unicode(uuid4()) + "}"
-        self.outPoints = []
+    def __init__(self, *points):
+        order = sorted(range(len(points)), key=points.__getitem__)
+        self.offsets = [points[pointIndex] for pointIndex in order]
+        self.order = order
+        self.outPoints = [None] * len(points)
+        self.pending = []
 
 
-    def annotate(self, text):
+    def pointsIn(self, line, offset):
         """
-        Add point references to a block of text.
-        """
-        return text[:self.point] + self.marker + text[self.point:]
-
+        Find the points which fall within a line of the original text.
 
-    def filterWords(self, words):
-        for word in words:
-            if self.isWord(word):
-                yield self.peek(word)
+        @param line: a line of the original text, without its newline.
+        @type line: L{unicode}
 
+        @param offset: the offset of C{line} within the original text.
+        @type offset: L{int}
 
-    def isWord(self, text):
+        @return: a C{list} of 2-tuples of C{(offsetInLine, pointIndex)}.
         """
-        Is the given word actually a word, or just an artifact of the
-        point-tracking process?  If it's just the point marker by itself, then
-        no, it isn't, and don't insert additional whitespace after it.
-        """
-        return not (text == self.marker)
+        lo = bisect_left(self.offsets, offset)
+        hi = bisect_right(self.offsets, offset + len(line), lo)
+        return [(self.offsets[each] - offset, self.order[each])
+                for each in range(lo, hi)]
 
 
-    def lengthOf(self, word):
+    def tokenize(self, line, offset):
         """
-        How long would this word be if it didn't have any point-markers in it?
+        Split a line of the original text into words, noting where any points
+        fall among them.
+
+        @return: a 2-tuple of a C{list} of words and a C{list} of 3-tuples of
+            C{(wordIndex, offsetInWord, pointIndex)}.  A point in whitespace
+            belongs to the end of the word before it; a point before the first
+            word on the line has a C{wordIndex} of C{-1}.
         """
-        return len(self.peek(word))
+        found = self.pointsIn(line, offset)
+        if not found:
+            return line.split(), found
+        words = []
+        starts = []
+        for match in _nonWhitespace.finditer(line):
+            words.append(match.group())
+            starts.append(match.start())
+        marks = []
+        for inLine, pointIndex in found:
+            wordIndex = bisect_right(starts, inLine) - 1
+            if wordIndex < 0:
+                marks.append((-1, 0, pointIndex))
+            else:
+                inWord = min(inLine - starts[wordIndex], len(words[wordIndex]))
+                marks.append((wordIndex, inWord, pointIndex))
+        return words, marks
 
 
-    def peek(self, word):
+    def place(self, position, pointIndexes):
         """
-        What would this word look like if it didn't have any point-markers in
-        it?
+        Remember that some points ended up at a given position in the output.
         """
-        return word.replace(self.marker, "")
+        for pointIndex in pointIndexes:
+            self.outPoints[pointIndex] = position
 
 
-    def extractPoints(self, text):
+    def writeLine(self, output, parts, linePoints):
         """
-        Return a C{list} of all point markers contained in the text.
+        Write a line of output, remembering the location of any points in it.
+
+        @param parts: the pieces of text which make up the line, not including
+            its trailing newline.
+        @type parts: C{list} of L{unicode}
+
+        @param linePoints: a C{list} of 2-tuples of C{(offsetInLine,
+            pointIndex)}.
         """
-        if self.marker in text:
-            return [self.marker]
-        return []
+        if linePoints:
+            position = output.tell()
+            for inLine, pointIndex in linePoints:
+                self.outPoints[pointIndex] = position + inLine
+        parts.append("\n")
+        output.write("".join(parts))
 
 
-    def scan(self, text, offset):
+    def finish(self, position):
         """
-        Scan some text for point markers, remember them, and remove them.
+        Any points which have not been placed anywhere else (because there was
+        no text after them) end up at the given position.
         """
-        idx = text.find(self.marker)
-        if idx == -1:
-            return text
-        self.outPoints.append(idx + offset)
-        return self.peek(text)
+        for pointIndex, outPoint in enumerate(self.outPoints):
+            if outPoint is None:
+                self.outPoints[pointIndex] = position
+        del self.pending[:]
 
 
 
@@ -390,31 +561,1116 @@ def wrapPythonDocstring(docstring, output, indentation="    ",
 
     @return: The new location of the cursor.
     """
-    # TODO: multiple points; usable, for example, for start and end of a
-    # currently active selection.
-    pt = PointTracker(point)
-    start = paragraph = RegularParagraph(pt)
-    docstring = pt.annotate(docstring)
-    for line in docstring.split("\n"):
-        paragraph = paragraph.add(line)
+    return wrapPythonDocstringPoints(docstring, output, indentation, width,
+                                     [point])[0]
+
+
+
+def wrapPythonDocstringPoints(docstring, output, indentation="    ",
+                              width=79, points=()):
+    """
+    Wrap a given Python docstring, keeping track of any number of points (such
+    as every cursor in a multiple selection) in a single pass.
+
+    The parameters not described here are the same as those of
+    L{wrapPythonDocstring}.
+
+    @param points: The locations of the cursors in the text, as offsets from
+        the beginning of the docstring.  Selected regions may be given as
+        2-tuples of the offsets of their ends.
+    @type points: C{list} of L{int} or 2-C{tuple}s of L{int}
+
+    @return: The new locations of the given points, in the same order and shape
+        as C{points}.
+    @rtype: C{list} of L{int} or 2-C{tuple}s of L{int}
+    """
+    flat = []
+    for each in points:
+        if isinstance(each, tuple):
+            flat.extend(each)
+        else:
+            flat.append(each)
+    pt = PointTracker(*flat)
+    for chunk in _wrapLines(docstring.split("\n"), output, indentation, width,
+                            pt):
+        pass
+    outPoints = iter(pt.outPoints)
+    result = []
+    for each in points:
+        if isinstance(each, tuple):
+            result.append(tuple([next(outPoints) for end in each]))
+        else:
+            result.append(next(outPoints))
+    return result
+
+
+
+def iterWrappedDocstring(lines, indentation="    ", width=79):
+    """
+    Wrap a given Python docstring (or any other epytext) a piece at a time, so
+    that only one paragraph at a time need be in memory.
+
+    The parameters not described here are the same as those of
+    L{wrapPythonDocstring}.
+
+    @param lines: the lines of the docstring, with or without their newlines;
+        for example, an open file.
+    @type lines: C{iterable} of L{unicode}
+
+    @return: an iterator of pieces of the wrapped docstring.  Each piece is
+        produced as soon as the paragraph it's part of is complete; all of them
+        together are what L{wrapPythonDocstring} would have written.
+    @rtype: C{iterator} of L{unicode}
+    """
+    output = _ChunkOutput()
+    for chunk in _wrapLines(_withoutNewlines(lines), output, indentation,
+                            width, PointTracker()):
+        if chunk:
+            yield chunk
+
+
+
+def _withoutNewlines(lines):
+    for line in lines:
+        if line.endswith("\n"):
+            line = line[:-1]
+        yield line
+
+
+
+class _ChunkOutput(object):
+    """
+    A file-like object which holds on to what's written to it only until it's
+    taken away.
+    """
+
+    def __init__(self):
+        self.pieces = []
+        self.position = 0
+
+
+    def tell(self):
+        return self.position
+
+
+    def write(self, text):
+        self.pieces.append(text)
+        self.position += len(text)
+
+
+    def take(self):
+        """
+        Remove and return everything written since the last call.
+        """
+        chunk = "".join(self.pieces)
+        del self.pieces[:]
+        return chunk
+
+
+
+def _paragraphs(lines, pointTracker):
+    """
+    Sort some lines into paragraphs.
+
+    @return: an iterator of the (non-empty) paragraphs, each produced as soon
+        as no more lines can be added to it, and forgotten once the next one
+        has been produced.
+    """
+    paragraph = unfinished = RegularParagraph(pointTracker)
+    offset = 0
+    for line in lines:
+        paragraph = paragraph.add(line, offset)
+        offset += len(line) + 1
+        while unfinished is not paragraph:
+            if unfinished:
+                yield unfinished
+            unfinished = unfinished.more
+    while unfinished is not None:
+        if unfinished:
+            yield unfinished
+        unfinished = unfinished.more
+
+
+
+def _wrapLines(lines, output, indentation, width, pointTracker):
+    """
+    Wrap the paragraphs in some lines, writing each to C{output} as soon as
+    it's complete.
+
+    @param output: a file-like object; if it has a C{take} method, like
+        L{_ChunkOutput}, its result is produced after each paragraph.
+
+    @return: an iterator of the results of C{output.take}, or of C{None}s.
+    """
+    take = getattr(output, "take", lambda: None)
     prevp = None
-    for paragraph in start.all():
+    for paragraph in _paragraphs(lines, pointTracker):
         if not paragraph.matchesTag(prevp):
             output.write("\n")
         prevp = paragraph
         paragraph.wrap(output, indentation, width)
+        yield take()
     output.write(indentation)
-    return pt.outPoints[0]
+    pointTracker.finish(output.tell())
+    yield take()
+
+
+
+def firstDifferentLine(expected, actual):
+    """
+    Find the first line on which two texts differ.
+
+    @return: the number of the line (counting from 0) in C{expected} on which
+        C{actual} first differs from it, or C{None} if they're the same.
+    @rtype: L{int} or L{NoneType}
+    """
+    if expected == actual:
+        return None
+    position = 0
+    for expectedChar, actualChar in zip(expected, actual):
+        if expectedChar != actualChar:
+            break
+        position += 1
+    return expected.count("\n", 0, position)
+
+
+
+def _splitLines(text):
+    """
+    Split some text into lines, keeping their newlines.
+    """
+    lines = text.split("\n")
+    last = lines.pop()
+    lines = [line + "\n" for line in lines]
+    if last:
+        lines.append(last)
+    return lines
+
+
+
+def lineEdits(original, wrapped):
+    """
+    Describe the difference between a docstring and its wrapped version as a
+    list of replaced ranges of whole lines, so that an editor can change only
+    the lines that need to change.
+
+    @param original: the docstring before wrapping.
+    @type original: L{unicode}
+
+    @param wrapped: the docstring after wrapping.
+    @type wrapped: L{unicode}
+
+    @return: 3-tuples of C{(start, end, replacement)}, where C{start} and
+        C{end} are offsets into C{original}, in ascending order and not
+        overlapping.  Replacing each range with its replacement, starting from
+        the last, turns C{original} into C{wrapped}.
+    @rtype: C{list} of 3-C{tuple}s of L{int}, L{int}, L{unicode}
+    """
+    if original == wrapped:
+        return []
+    before = _splitLines(original)
+    after = _splitLines(wrapped)
+    offsets = [0]
+    for line in before:
+        offsets.append(offsets[-1] + len(line))
+    # Most of a docstring usually survives wrapping untouched at either end,
+    # so don't make SequenceMatcher look at that part.
+    head = 0
+    while (head < len(before) and head < len(after) and
+           before[head] == after[head]):
+        head += 1
+    tail = 0
+    while (tail < len(before) - head and tail < len(after) - head and
+           before[-1 - tail] == after[-1 - tail]):
+        tail += 1
+    matcher = SequenceMatcher(None, before[head:len(before) - tail],
+                              after[head:len(after) - tail])
+    edits = []
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag != "equal":
+            edits.append((offsets[head + i1], offsets[head + i2],
+                          "".join(after[head + j1:head + j2])))
+    return edits
+
+
+
+class _Mismatch(Exception):
+    """
+    Raised by L{_ComparingOutput} as soon as the text written to it differs
+    from what was expected.
+
+    @ivar line: the number of the line (counting from 0) of the expected text
+        where the difference is.
+    """
+
+    def __init__(self, line):
+        Exception.__init__(self, line)
+        self.line = line
+
+
+
+class _ComparingOutput(object):
+    """
+    A file-like object which, rather than keeping the text written to it,
+    compares it against some expected text.
+    """
+
+    def __init__(self, expected):
+        self.expected = expected
+        self.position = 0
+
+
+    def tell(self):
+        return self.position
+
+
+    def write(self, text):
+        """
+        Compare some text against the expected text at the current position.
+
+        @raise _Mismatch: if it doesn't match.
+        """
+        if not self.expected.startswith(text, self.position):
+            where = self.expected[:self.position]
+            raise _Mismatch(where.count("\n") + firstDifferentLine(
+                self.expected[self.position:self.position + len(text)], text
+            ))
+        self.position += len(text)
+
+
+    def finish(self):
+        """
+        There won't be any more text written.
+
+        @raise _Mismatch: if some of the expected text was never written.
+        """
+        if self.position != len(self.expected):
+            raise _Mismatch(self.expected.count("\n", 0, self.position))
+
+
+
+def checkPythonDocstring(docstring, indentation="    ", width=79):
+    """
+    Check whether a given Python docstring is wrapped already, stopping at the
+    first line that isn't, and without building the wrapped docstring.
+
+    The parameters are the same as those of L{wrapPythonDocstring}.
+
+    @return: C{None} if wrapping C{docstring} would leave it unchanged;
+        otherwise, the number of the first line (counting from 0) that it would
+        change.
+    @rtype: L{int} or L{NoneType}
+    """
+    output = _ComparingOutput(docstring)
+    try:
+        wrapPythonDocstring(docstring, output, indentation, width)
+        output.finish()
+    except _Mismatch, mismatch:
+        return mismatch.line
+    return None
+
+
+
+_docstringQuotes = re.compile(r"""([uUrR]*)(\"\"\"|''')""")
+
+
+
+def findDocstrings(source):
+    """
+    Find the triple-quoted docstrings of the module, classes and functions in
+    some Python source code.
+
+    @param source: the text of a Python module.
+    @type source: L{unicode}
+
+    @return: a C{list} of 3-tuples of C{(start, end, indentation)}, where
+        C{start} and C{end} are the offsets in C{source} of the text between
+        the quotes and C{indentation} is the whitespace before the opening
+        quotes.
+
+    @raise tokenize.TokenError: if C{source} can't be tokenized.
+    """
+    lineOffsets = [0]
+    for line in source.split("\n"):
+        lineOffsets.append(lineOffsets[-1] + len(line) + 1)
+    found = []
+    # Is the next statement in a position to be a docstring?
+    expecting = True
+    candidate = None
+    firstWord = None
+    blockHeader = False
+    readline = StringIO(source).readline
+    for (kind, text, (srow, scol), (erow, ecol),
+         line) in tokenize.generate_tokens(readline):
+        if kind in (tokenize.COMMENT, tokenize.NL, tokenize.DEDENT):
+            continue
+        if kind == tokenize.NEWLINE:
+            # Only a string that's a statement all by itself is a docstring.
+            if candidate is not None:
+                found.append(candidate)
+            blockHeader = firstWord in ("def", "class")
+            candidate = firstWord = None
+            expecting = False
+            continue
+        if kind == tokenize.INDENT:
+            expecting = blockHeader
+            continue
+        if firstWord is None:
+            firstWord = text
+        candidate = None
+        if expecting and kind == tokenize.STRING:
+            quotes = _docstringQuotes.match(text)
+            indentation = line[:scol]
+            if quotes is not None and not indentation.strip():
+                start = (lineOffsets[srow - 1] + scol +
+                         len(quotes.group(1)) + 3)
+                end = lineOffsets[erow - 1] + ecol - 3
+                candidate = (start, end, indentation)
+        expecting = False
+    return found
+
+
+
+class WrapCache(object):
+    """
+    A memory, kept on disk between runs, of the work done by L{wrapTree}.
+
+    It remembers the result of wrapping each docstring (keyed by a hash of the
+    docstring along with the width and indentation it was wrapped with), and
+    the modification time and size of each file that was completely wrapped, so
+    that a file which hasn't been touched since need not even be read.
+
+    Everything is forgotten when L{WRAPPER_VERSION} changes.
+
+    @ivar docstrings: mapping of docstring keys to wrapped docstrings, or to
+        C{None} for docstrings that were already wrapped.
+
+    @ivar files: mapping of absolute file names to a C{list} of their
+        modification time, size and the width they were wrapped to.
+
+    @ivar learned: the entries added to C{docstrings} since this cache was
+        loaded (or since the worker process using it started on a new file).
+
+    @ivar used: the keys of the entries in C{docstrings} which have been looked
+        up since then.
+    """
+
+    # Once there are more docstrings remembered than this, only the ones that
+    # were used in the current run are saved.
+    maxDocstrings = 200000
+
+    def __init__(self, path=None):
+        self.path = path
+        self.docstrings = {}
+        self.files = {}
+        self.learned = {}
+        self.used = set()
+
+
+    def load(self):
+        """
+        Read the cache from C{self.path}, if it exists and was written by this
+        version of the wrapper.
+        """
+        try:
+            f = open(self.path, "rb")
+        except IOError:
+            return
+        try:
+            try:
+                saved = json.loads(f.read().decode("utf-8"))
+            except ValueError:
+                return
+        finally:
+            f.close()
+        if saved.get("version") != WRAPPER_VERSION:
+            return
+        self.docstrings = saved["docstrings"]
+        self.files = saved["files"]
+
+
+    def save(self):
+        """
+        Write the cache to C{self.path}.
+        """
+        docstrings = self.docstrings
+        if len(docstrings) > self.maxDocstrings:
+            docstrings = dict((key, value)
+                              for (key, value) in docstrings.items()
+                              if key in self.used or key in self.learned)
+        writeAtomically(self.path, json.dumps({
+            "version": WRAPPER_VERSION,
+            "docstrings": docstrings,
+            "files": self.files,
+        }).encode("utf-8"))
+
+
+    def _key(self, docstring, indentation, width):
+        return hashlib.sha1(
+            ("%d\n%s\n%s" % (width, indentation, docstring)).encode("utf-8")
+        ).hexdigest()
+
+
+    def lookup(self, docstring, indentation, width):
+        """
+        Find the remembered result of wrapping a docstring.
+
+        @return: the wrapped docstring, or C{None} if it isn't known.
+        @rtype: L{unicode} or L{NoneType}
+        """
+        key = self._key(docstring, indentation, width)
+        if key not in self.docstrings:
+            return None
+        self.used.add(key)
+        wrapped = self.docstrings[key]
+        if wrapped is None:
+            return docstring
+        return wrapped
+
+
+    def remember(self, docstring, indentation, width, wrapped):
+        """
+        Remember the result of wrapping a docstring.
+        """
+        key = self._key(docstring, indentation, width)
+        if wrapped == docstring:
+            wrapped = None
+        self.docstrings[key] = self.learned[key] = wrapped
+
+
+    def merge(self, learned, used):
+        """
+        Take on the C{learned} and C{used} of a L{WrapCache} in a worker
+        process.
+        """
+        self.docstrings.update(learned)
+        self.learned.update(learned)
+        self.used.update(used)
+
+
+    def isWrapped(self, path, width):
+        """
+        Is a file known to be completely wrapped already?
+        """
+        try:
+            st = os.stat(path)
+        except OSError:
+            return False
+        return (self.files.get(os.path.abspath(path)) ==
+                [st.st_mtime, st.st_size, width])
+
+
+    def noteWrapped(self, path, width):
+        """
+        Remember that a file is now completely wrapped.
+        """
+        st = os.stat(path)
+        self.files[os.path.abspath(path)] = [st.st_mtime, st.st_size, width]
+
+
+
+def wrapDocstringsIn(source, width=79, cache=None):
+    """
+    Wrap every docstring in some Python source code.
+
+    @param source: the text of a Python module.
+    @type source: L{unicode}
+
+    @param width: The maximum number of characters allowed in a wrapped line.
+    @type width: L{int}
+
+    @param cache: the results of wrapping docstrings previously, which will
+        also be updated with the results of wrapping these ones.
+    @type cache: L{WrapCache} or L{NoneType}
+
+    @return: the text of the module, with its docstrings wrapped.
+    @rtype: L{unicode}
+    """
+    pieces = []
+    last = 0
+    for start, end, indentation in findDocstrings(source):
+        original = source[start:end]
+        wrapped = None
+        if cache is not None:
+            wrapped = cache.lookup(original, indentation, width)
+        if wrapped is None:
+            output = StringIO()
+            wrapPythonDocstring(original, output, indentation, width)
+            wrapped = output.getvalue()
+            if cache is not None:
+                cache.remember(original, indentation, width, wrapped)
+        pieces.append(source[last:start])
+        pieces.append(wrapped)
+        last = end
+    pieces.append(source[last:])
+    return "".join(pieces)
+
+
+
+def checkDocstringsIn(source, width=79, cache=None):
+    """
+    Find the docstrings in some Python source code which are not wrapped.
+
+    @param source: the text of a Python module.
+    @type source: L{unicode}
+
+    @param width: The maximum number of characters allowed in a wrapped line.
+    @type width: L{int}
+
+    @param cache: see L{wrapDocstringsIn}.
+    @type cache: L{WrapCache} or L{NoneType}
+
+    @return: for each docstring that is not wrapped, the number of the line
+        (counting from 1) in C{source} where wrapping it would first change it.
+    @rtype: C{list} of L{int}
+    """
+    lines = []
+    lineNumber = 1
+    counted = 0
+    for start, end, indentation in findDocstrings(source):
+        original = source[start:end]
+        known = None
+        if cache is not None:
+            known = cache.lookup(original, indentation, width)
+        if known is not None:
+            different = firstDifferentLine(original, known)
+        else:
+            different = checkPythonDocstring(original, indentation, width)
+            if different is None and cache is not None:
+                cache.remember(original, indentation, width, original)
+        if different is not None:
+            lineNumber += source.count("\n", counted, start)
+            counted = start
+            lines.append(lineNumber + different)
+    return lines
+
+
+
+def writeAtomically(path, data):
+    """
+    Replace the contents of a file in one step, so that nothing (including an
+    interrupted run) ever sees it half-written.
+
+    @param path: the name of the file to replace.
+    @type path: L{str}
+
+    @param data: the new contents of the file.
+    @type data: L{bytes}
+    """
+    directory, name = os.path.split(path)
+    fd, temporary = tempfile.mkstemp(prefix="." + name + ".", suffix=".new",
+                                     dir=directory or ".")
+    try:
+        f = os.fdopen(fd, "wb")
+        try:
+            f.write(data)
+        finally:
+            f.close()
+        if os.path.exists(path):
+            shutil.copymode(path, temporary)
+        os.rename(temporary, path) # atomic but not concurrent
+    except:
+        os.unlink(temporary)
+        raise
+
+
+
+_sourceErrors = (UnicodeDecodeError, tokenize.TokenError, IndentationError)
+
+def _readSource(path):
+    """
+    Read a Python source file.
+
+    @return: a 2-tuple of the text of the file, with its line endings
+        normalized to C{"\\n"}, and whether it originally had Windows line
+        endings.
+    @rtype: 2-C{tuple} of L{unicode} and L{bool}
+    """
+    f = open(path, "rb")
+    try:
+        data = f.read()
+    finally:
+        f.close()
+    source = data.decode("utf-8")
+    crlf = "\r\n" in source
+    if crlf:
+        source = source.replace("\r\n", "\n")
+    return source, crlf
+
+
+
+def wrapFile(path, width=79, cache=None):
+    """
+    Wrap every docstring in a Python source file, rewriting it in place if
+    anything changed.
+
+    @param path: the name of the file to wrap.
+    @type path: L{str}
+
+    @param width: The maximum number of characters allowed in a wrapped line.
+    @type width: L{int}
+
+    @param cache: see L{wrapDocstringsIn}.
+    @type cache: L{WrapCache} or L{NoneType}
+
+    @return: a 3-tuple of C{(path, changed, error)}, where C{error} is C{None}
+        or a description of why the file could not be wrapped.
+    """
+    try:
+        source, crlf = _readSource(path)
+        wrapped = wrapDocstringsIn(source, width, cache)
+    except _sourceErrors, e:
+        return (path, False, "%s: %s" % (e.__class__.__name__, e))
+    if wrapped == source:
+        return (path, False, None)
+    if crlf:
+        wrapped = wrapped.replace("\n", "\r\n")
+    writeAtomically(path, wrapped.encode("utf-8"))
+    return (path, True, None)
+
+
+
+def checkFile(path, width=79, cache=None):
+    """
+    Find the docstrings in a Python source file which are not wrapped, without
+    changing it.
+
+    @param path: the name of the file to check.
+    @type path: L{str}
+
+    @param width: The maximum number of characters allowed in a wrapped line.
+    @type width: L{int}
+
+    @param cache: see L{wrapDocstringsIn}.
+    @type cache: L{WrapCache} or L{NoneType}
+
+    @return: a 3-tuple of C{(path, lines, error)}, where C{lines} is the result
+        of L{checkDocstringsIn} and C{error} is C{None} or a description of why
+        the file could not be checked.
+    """
+    try:
+        source, crlf = _readSource(path)
+        return (path, checkDocstringsIn(source, width, cache), None)
+    except _sourceErrors, e:
+        return (path, [], "%s: %s" % (e.__class__.__name__, e))
+
+
+
+_workerCache = None
+
+def _initWorker(docstrings):
+    """
+    Set up a worker process for L{wrapTree}.
+
+    @param docstrings: the C{docstrings} of the L{WrapCache} in use, or C{None}
+        if there isn't one.
+    """
+    global _workerCache
+    if docstrings is not None:
+        _workerCache = WrapCache()
+        _workerCache.docstrings = docstrings
+
+
+
+def _wrapFileInWorker(args):
+    """
+    L{wrapFile} or L{checkFile}, taking its arguments as a single tuple, for
+    C{multiprocessing.Pool.imap_unordered}.
+
+    @return: a 3-tuple of the result of L{wrapFile} or L{checkFile}, and the
+        C{learned} and C{used} of the worker's L{WrapCache}, to be merged into
+        the main one.
+    """
+    function, path, width = args
+    cache = _workerCache
+    if cache is None:
+        return function(path, width), {}, []
+    cache.learned = {}
+    cache.used = set()
+    return function(path, width, cache), cache.learned, list(cache.used)
+
+
+
+def findSourceFiles(paths):
+    """
+    Find all the Python source files among some files and directories, skipping
+    hidden directories (such as C{.git}).
+
+    @param paths: the names of files and directories.
+    @type paths: C{iterable} of L{str}
+
+    @return: an iterable of file names.
+    """
+    for path in paths:
+        if not os.path.isdir(path):
+            yield path
+            continue
+        for directory, subdirectories, files in os.walk(path):
+            subdirectories[:] = sorted(name for name in subdirectories
+                                       if not name.startswith("."))
+            for name in sorted(files):
+                if name.endswith(".py"):
+                    yield os.path.join(directory, name)
+
+
+
+def wrapTree(paths, width=79, processes=None, cache=None, check=False):
+    """
+    Wrap every docstring in all the Python source files among some files and
+    directories, spreading the work across a pool of processes.
+
+    If a L{WrapCache} is given, files which it knows to be wrapped already are
+    skipped (and reported as unchanged), and docstrings it knows about aren't
+    wrapped again.  It is updated with everything done here, but not saved.
+
+    @param paths: the names of files and directories.
+    @type paths: C{iterable} of L{str}
+
+    @param width: The maximum number of characters allowed in a wrapped line.
+    @type width: L{int}
+
+    @param processes: the number of worker processes to use: C{None} for one
+        per CPU, or C{1} to do all the work in this process.
+    @type processes: L{int} or L{NoneType}
+
+    @param cache: the results of previous runs.
+    @type cache: L{WrapCache} or L{NoneType}
+
+    @param check: if true, only check the files with L{checkFile} rather than
+        changing them.
+    @type check: L{bool}
+
+    @return: an iterable of the results of L{wrapFile} (or L{checkFile}), in no
+        particular order.
+    """
+    if check:
+        function = checkFile
+        nothing = []
+    else:
+        function = wrapFile
+        nothing = False
+    work = []
+    for path in findSourceFiles(paths):
+        if cache is not None and cache.isWrapped(path, width):
+            yield (path, nothing, None)
+        else:
+            work.append((function, path, width))
+    def noteResult(path, changed, error):
+        # After wrapFile, a file is wrapped even if it was changed; after
+        # checkFile, only if there was nothing to change.
+        if cache is not None and error is None and not (check and changed):
+            cache.noteWrapped(path, width)
+    if processes == 1:
+        for function, path, width in work:
+            result = function(path, width, cache)
+            noteResult(*result)
+            yield result
+        return
+    # Imported here because the editor never needs it, and Sublime Text's
+    # bundled Python doesn't always include it.
+    from multiprocessing import Pool
+    docstrings = None
+    if cache is not None:
+        docstrings = cache.docstrings
+    pool = Pool(processes, _initWorker, (docstrings,))
+    try:
+        for result, learned, used in pool.imap_unordered(_wrapFileInWorker,
+                                                         work, 16):
+            if cache is not None:
+                cache.merge(learned, used)
+            noteResult(*result)
+            yield result
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+
+_parseError = -32700
+_invalidRequest = -32600
+_methodNotFound = -32601
+_invalidParams = -32602
+_internalError = -32603
+
+class _BadRequest(Exception):
+    """
+    A request to L{serve} couldn't be carried out.
+
+    @ivar code: the JSON-RPC error code describing the problem.
+    """
+
+    def __init__(self, code, message):
+        Exception.__init__(self, message)
+        self.code = code
+
+
+
+def _isInteger(value):
+    """
+    Is a decoded JSON value an integer?  (JSON's C{true} and C{false} are
+    decoded as L{bool}s, which are L{int}s too, but aren't integers.)
+    """
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+
+def _jsonPoints(points, length):
+    """
+    Convert the C{points} parameter of a request to L{serve} into what
+    L{wrapPythonDocstringPoints} expects.
+
+    @param length: the length of the docstring, which every point must be
+        within.
+    """
+    if not isinstance(points, list):
+        raise _BadRequest(_invalidParams, "points must be a list")
+    def isPoint(value):
+        return _isInteger(value) and 0 <= value <= length
+    result = []
+    for each in points:
+        if isinstance(each, list):
+            if len(each) != 2 or not all(isPoint(end) for end in each):
+                raise _BadRequest(
+                    _invalidParams,
+                    "a selected region must be 2 offsets into the docstring")
+            each = tuple(each)
+        elif not isPoint(each):
+            raise _BadRequest(
+                _invalidParams,
+                "a point must be an offset into the docstring, or 2 of them")
+        result.append(each)
+    return result
+
+
+
+def handleRequest(request):
+    """
+    Carry out a single request to L{serve}.
+
+    @param request: a decoded JSON-RPC request, whose C{method} is C{"wrap"} or
+        C{"check"}, and whose C{params} are a C{docstring}, and optionally its
+        C{indentation}, the C{width} to wrap it to, and (for C{"wrap"}) a list
+        of C{points} as in L{wrapPythonDocstringPoints}, with selected regions
+        given as 2-element lists.
+    @type request: C{dict}
+
+    @return: the result of the request: for C{"wrap"}, a C{dict} of the wrapped
+        C{docstring} and the new C{points}; for C{"check"}, a C{dict} whose
+        C{line} is the result of L{checkPythonDocstring}.
+    @rtype: C{dict}
+
+    @raise _BadRequest: if the request isn't one of those.
+    """
+    if not isinstance(request, dict):
+        raise _BadRequest(_invalidRequest, "a request must be an object")
+    method = request.get("method")
+    if method not in ("wrap", "check"):
+        raise _BadRequest(_methodNotFound,
+                          "no such method: %s" % (json.dumps(method),))
+    params = request.get("params", {})
+    if not isinstance(params, dict):
+        raise _BadRequest(_invalidParams, "params must be an object")
+    docstring = params.get("docstring")
+    indentation = params.get("indentation", "    ")
+    width = params.get("width", 79)
+    if not isinstance(docstring, unicode):
+        raise _BadRequest(_invalidParams, "docstring must be a string")
+    if not isinstance(indentation, unicode) or indentation.strip():
+        raise _BadRequest(_invalidParams, "indentation must be spaces")
+    if not _isInteger(width) or width < 1:
+        raise _BadRequest(_invalidParams, "width must be a positive integer")
+    if method == "wrap":
+        points = _jsonPoints(params.get("points", []), len(docstring))
+        output = StringIO()
+        points = wrapPythonDocstringPoints(docstring, output, indentation,
+                                           width, points)
+        return dict(docstring=output.getvalue(), points=points)
+    else:
+        return dict(line=checkPythonDocstring(docstring, indentation, width))
+
+
+
+def _serveLine(line):
+    """
+    Carry out a request to L{serve}.
+
+    @param line: a line of JSON, as read.
+    @type line: L{bytes}
+
+    @return: the JSON-RPC response, encoded as a line of JSON, or C{None} if
+        C{line} is blank or the request is a notification (that is, it has no
+        C{id}), which gets no response, even if it fails.
+    @rtype: L{bytes} or L{NoneType}
+    """
+    if not line.strip():
+        return None
+    requestID = None
+    notification = False
+    try:
+        try:
+            request = json.loads(line.decode("utf-8"))
+        except ValueError, e:
+            raise _BadRequest(_parseError, unicode(e))
+        if isinstance(request, dict):
+            requestID = request.get("id")
+            notification = "id" not in request
+        response = dict(id=requestID, result=handleRequest(request))
+    except _BadRequest, e:
+        response = dict(id=requestID,
+                        error=dict(code=e.code, message=unicode(e)))
+    except Exception, e:
+        # A bug, rather than a bad request; it mustn't stop the server from
+        # answering everyone else.
+        response = dict(id=requestID,
+                        error=dict(code=_internalError,
+                                   message="%s: %s" % (e.__class__.__name__,
+                                                       e)))
+    if notification:
+        return None
+    response["jsonrpc"] = "2.0"
+    return json.dumps(response, sort_keys=True).encode("utf-8") + b"\n"
+
+
+
+def serve(stdin, stdout, processes=None):
+    """
+    Answer JSON-RPC requests to wrap or check docstrings, one per line on
+    C{stdin}, until it's closed; see L{handleRequest} for what they look like.
+
+    Requests are read as soon as they arrive and carried out concurrently, so a
+    client may send many before reading any responses.  Each response is
+    written to C{stdout} (as a line of JSON) as soon as it's ready, which may
+    not be the order the requests were sent in; give each request an C{id} to
+    tell the responses apart.
+
+    @param processes: the number of worker processes to use: C{None} for one
+        per CPU, or C{1} to answer each request in this process, in order.
+    @type processes: L{int} or L{NoneType}
+
+    @return: the exit status for the process.
+    @rtype: L{int}
+    """
+    lines = iter(stdin.readline, b"")
+    if processes == 1:
+        responses = (_serveLine(line) for line in lines)
+        pool = None
+    else:
+        from multiprocessing import Pool
+        pool = Pool(processes)
+        responses = pool.imap_unordered(_serveLine, lines)
+    try:
+        for response in responses:
+            if response is not None:
+                stdout.write(response)
+                stdout.flush()
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+    return 0
+
+
+
+def main(argv, stdin, stdout, stderr):
+    """
+    Run this module as a script.
+
+    With no arguments, wrap the single docstring on C{stdin}, writing each
+    paragraph to C{stdout} as soon as it's been read; otherwise, wrap every
+    docstring in the named files and directories, in place.  With C{--check},
+    report the docstrings that aren't wrapped rather than changing anything.
+    With C{--server}, L{serve} requests until C{stdin} is closed.
+
+    @return: the exit status for the process.
+    @rtype: L{int}
+    """
+    from optparse import OptionParser
+    parser = OptionParser(
+        usage="%prog [options] [PATH ...]",
+        description=("Wrap the docstring on standard input, or every "
+                     "docstring in the given files and directories.")
+    )
+    parser.add_option("-w", "--width", type="int", default=79,
+                      help="maximum line length [default: %default]")
+    parser.add_option("-j", "--jobs", type="int", default=None,
+                      help="number of worker processes [default: one per "
+                      "CPU]")
+    parser.add_option("--cache", metavar="FILE", default=None,
+                      help="remember which files and docstrings are already "
+                      "wrapped in FILE, to skip them on the next run")
+    parser.add_option("--check", action="store_true", default=False,
+                      help="don't change anything; list the docstrings that "
+                      "need wrapping, and exit with status 1 if there are "
+                      "any")
+    parser.add_option("--server", action="store_true", default=False,
+                      help="keep running, answering JSON-RPC requests to "
+                      "wrap or check docstrings, one per line on standard "
+                      "input")
+    options, paths = parser.parse_args(argv)
+
+    if options.server:
+        return serve(stdin, stdout, options.jobs)
+
+    if not paths:
+        lines = (line.decode("utf-8") for line in iter(stdin.readline, b""))
+        # Lines up to (and including) the first non-empty one, which says how
+        # far to indent.
+        seen = []
+        for line in lines:
+            seen.append(line)
+            if line.rstrip("\n"):
+                break
+        firstline = seen[-1]
+        indentation = " " * (len(firstline) - len(firstline.lstrip()))
+        if options.check:
+            indata = "".join(seen + list(lines))
+            different = checkPythonDocstring(indata, indentation,
+                                             options.width)
+            if different is None:
+                return 0
+            stdout.write("<stdin>:%d: docstring is not wrapped\n" %
+                         (different + 1,))
+            return 1
+        for chunk in iterWrappedDocstring(chain(seen, lines), indentation,
+                                          options.width):
+            stdout.write(chunk.encode("utf-8"))
+        stdout.flush()
+        return 0
+
+    cache = None
+    if options.cache is not None:
+        cache = WrapCache(options.cache)
+        cache.load()
+
+    changed = unchanged = failed = 0
+    for path, didChange, error in wrapTree(paths, options.width,
+                                           options.jobs, cache,
+                                           options.check):
+        if error is not None:
+            failed += 1
+            stderr.write("%s: %s\n" % (path, error))
+        elif didChange:
+            changed += 1
+            if options.check:
+                for line in didChange:
+                    stdout.write("%s:%d: docstring is not wrapped\n" %
+                                 (path, line))
+            else:
+                stdout.write("%s\n" % (path,))
+        else:
+            unchanged += 1
+    if options.check:
+        stderr.write("%d need wrapping, %d already wrapped, %d failed\n" %
+                     (changed, unchanged, failed))
+    else:
+        stderr.write("%d reformatted, %d unchanged, %d failed\n" %
+                     (changed, unchanged, failed))
+    if cache is not None:
+        cache.save()
+    return int(bool(failed or (options.check and changed)))
 
 
 
 if __name__ == '__main__':
     import sys
-    from cStringIO import StringIO
-    io = StringIO()
-    indata = sys.stdin.read()
-    firstline = [line for line in indata.split("\n") if line][0]
-    wrapPythonDocstring(indata, io,
-                        indentation=" " * (len(firstline) - len(firstline.lstrip())))
-    sys.stdout.write(io.getvalue())
-    sys.stdout.flush()
+    sys.exit(main(sys.argv[1:], sys.stdin, sys.stdout, sys.stderr))
@@ -0,0 +1,274 @@
+# Copyright (C) 2012
+# See LICENSE.txt for details.
+
+"""
+Benchmarks for L{epywrap}.
+
+Run this file as a script to wrap generated docstrings of several shapes
+(prose, nested lists, fields, preformatted blocks and headings), each at a
+series of growing sizes.  The time and peak memory taken for each are written
+out as JSON, and the script exits with status 1 if the time per character for
+any shape grows by more than the tolerance between the smallest and largest
+sizes; that is, if wrapping has stopped scaling linearly.
+"""
+
+from __future__ import unicode_literals
+
+import sys
+import json
+import time
+
+from io import StringIO
+
+from epywrap import wrapPythonDocstringPoints, WRAPPER_VERSION
+
+SENTENCE = ("Lorem ipsum dolor sit amet, consectetur adipiscing elit, sed do "
+            "eiusmod tempor incididunt ut labore et dolore magna aliqua.  Was "
+            "it U.S.A. or E.U. policy?  Nobody knows!  ")
+
+
+
+def prose(size):
+    """
+    Long paragraphs of running text.
+    """
+    return ["    " + SENTENCE * 4 + "\n\n" for i in range(size)]
+
+
+
+def lists(size):
+    """
+    Bulleted and numbered lists, nested a few levels deep.
+    """
+    parts = []
+    for i in range(size):
+        depth = " " * (4 * (i % 4))
+        parts.append("    %s- %s\n" % (depth, SENTENCE))
+        parts.append("    %s%d. %s\n" % (depth, i + 1, SENTENCE))
+        if i % 4 == 3:
+            parts.append("\n")
+    return parts
+
+
+
+def fields(size):
+    """
+    Many C{@param} and C{@type} fields, as in a long function signature.
+    """
+    parts = ["    Do something with lots of arguments.\n\n"]
+    for i in range(size):
+        parts.append("    @param argument%d: %s\n" % (i, SENTENCE))
+        parts.append("    @type argument%d: L{int}\n\n" % (i,))
+    parts.append("    @return: %s\n    @rtype: L{str}\n" % (SENTENCE,))
+    return parts
+
+
+
+def preformatted(size):
+    """
+    Big C{::} blocks of code.
+    """
+    parts = []
+    for i in range(size):
+        if i % 50 == 0:
+            parts.append("\n    For example::\n\n")
+        parts.append("        value%d = compute(%d, '%s')\n" % (i, i, SENTENCE))
+        if i % 10 == 0:
+            parts.append("            indented(%d)\n\n" % (i,))
+    return parts
+
+
+
+def headings(size):
+    """
+    Section headings, each followed by a short paragraph.
+    """
+    parts = []
+    for i in range(size):
+        title = "Section %d" % (i,)
+        parts.append("    %s\n    %s\n\n    %s\n\n" %
+                     (title, "=-"[i % 2] * len(title), SENTENCE))
+    return parts
+
+
+
+SHAPES = [prose, lists, fields, preformatted, headings]
+
+
+
+def generate(shape, size):
+    """
+    Generate a docstring.
+
+    @param shape: one of L{SHAPES}.
+
+    @param size: how many repetitions of the shape's basic unit to include.
+    @type size: L{int}
+
+    @rtype: L{unicode}
+    """
+    return "\n" + "".join(shape(size)) + "    "
+
+
+
+def peakKilobytes():
+    """
+    The peak resident memory of this process so far, in kilobytes, or C{None}
+    on platforms where that can't be found out.
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        # bytes, not kilobytes
+        peak //= 1024
+    return peak
+
+
+
+def measure(shape, size, repeat):
+    """
+    Wrap a generated docstring.
+
+    @return: a C{dict} describing the docstring, the best time (in seconds) out
+        of C{repeat} attempts at wrapping it, and how much the peak memory of
+        the process grew (in kilobytes) while doing so.
+    """
+    docstring = generate(shape, size)
+    # A handful of cursors spread through the text, so that point-tracking is
+    # measured too.
+    points = range(0, len(docstring), max(1, len(docstring) // 8))
+    before = peakKilobytes()
+    best = None
+    for attempt in range(repeat):
+        started = time.time()
+        wrapPythonDocstringPoints(docstring, StringIO(), points=points)
+        elapsed = time.time() - started
+        if best is None or elapsed < best:
+            best = elapsed
+    after = peakKilobytes()
+    growth = None
+    if before is not None:
+        growth = after - before
+    return dict(shape=shape.__name__, size=size, characters=len(docstring),
+                seconds=best, peakKilobytes=growth)
+
+
+
+def _measureInChild(connection, shapeName, size, repeat):
+    shape = dict((each.__name__, each) for each in SHAPES)[shapeName]
+    connection.send(measure(shape, size, repeat))
+    connection.close()
+
+
+
+def measureIsolated(shape, size, repeat):
+    """
+    Like L{measure}, but in a new process, so that the memory used by one
+    measurement doesn't hide the memory used by the next.
+    """
+    from multiprocessing import Pipe, Process
+    parent, child = Pipe()
+    process = Process(target=_measureInChild,
+                      args=(child, shape.__name__, size, repeat))
+    process.start()
+    result = parent.recv()
+    process.join()
+    return result
+
+
+
+def checkScaling(results, tolerance):
+    """
+    Compare the time per character for the smallest and largest sizes of each
+    shape.
+
+    @param results: results of L{measure}.
+
+    @param tolerance: the largest acceptable ratio.
+    @type tolerance: L{float}
+
+    @return: a C{list} of C{dict}s with the ratio for each shape, and whether
+        it's acceptable.
+    """
+    byShape = {}
+    for result in results:
+        byShape.setdefault(result["shape"], []).append(result)
+    scaling = []
+    for shape in SHAPES:
+        measured = sorted(byShape.get(shape.__name__, []),
+                          key=lambda result: result["characters"])
+        if len(measured) < 2:
+            continue
+        smallest, largest = measured[0], measured[-1]
+        # Too fast to measure is as good as linear.
+        perCharacter = [max(result["seconds"], 1e-6) / result["characters"]
+                        for result in (smallest, largest)]
+        ratio = perCharacter[1] / perCharacter[0]
+        scaling.append(dict(shape=shape.__name__, ratio=ratio,
+                            ok=ratio <= tolerance))
+    return scaling
+
+
+
+def main(argv, stdout, stderr):
+    """
+    Run the benchmarks as a script.
+
+    @return: the exit status for the process.
+    @rtype: L{int}
+    """
+    from optparse import OptionParser
+    parser = OptionParser(
+        usage="%prog [options]",
+        description=("Measure how long epywrap takes to wrap docstrings of "
+                     "growing size, and check that it grows linearly.")
+    )
+    parser.add_option("--sizes", default="250,500,1000,2000",
+                      help="comma-separated sizes to generate "
+                      "[default: %default]")
+    parser.add_option("--repeat", type="int", default=3,
+                      help="take the best of this many runs "
+                      "[default: %default]")
+    parser.add_option("--tolerance", type="float", default=2.0,
+                      help="largest acceptable growth in time per character "
+                      "from the smallest to the largest size "
+                      "[default: %default]")
+    parser.add_option("--output", metavar="FILE", default=None,
+                      help="write the JSON report to FILE instead of standard "
+                      "output")
+    options, arguments = parser.parse_args(argv)
+    sizes = [int(size) for size in options.sizes.split(",")]
+
+    results = []
+    for shape in SHAPES:
+        for size in sizes:
+            result = measureIsolated(shape, size, options.repeat)
+            stderr.write("%(shape)s %(size)d: %(characters)d characters in "
+                         "%(seconds).4fs\n" % result)
+            results.append(result)
+    scaling = checkScaling(results, options.tolerance)
+    report = json.dumps(dict(wrapperVersion=WRAPPER_VERSION,
+                             python=sys.version.split()[0],
+                             results=results, scaling=scaling),
+                        indent=2, sort_keys=True)
+    if options.output is None:
+        stdout.write(report + "\n")
+    else:
+        f = open(options.output, "wb")
+        try:
+            f.write(report.encode("utf-8") + b"\n")
+        finally:
+            f.close()
+    failures = [each for each in scaling if not each["ok"]]
+    for each in failures:
+        stderr.write("%(shape)s does not scale linearly: time per character "
+                     "grew by %(ratio).2fx\n" % each)
+    return int(bool(failures))
+
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:], sys.stdout, sys.stderr))
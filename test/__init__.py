@@ -0,0 +1,6 @@
+# Copyright (C) 2012
+# See LICENSE.txt for details.
+
+"""
+Tests for the parts of E-Max that don't depend on Sublime.
+"""
@@ -0,0 +1,314 @@
+# Copyright (C) 2012
+# See LICENSE.txt for details.
+
+"""
+Tests for L{emax_kill_ring}.
+"""
+
+from __future__ import unicode_literals
+
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+import emax_kill_ring
+from emax_kill_ring import KillRing, KillLog
+
+
+
+class KillRingTests(unittest.TestCase):
+    """
+    Tests for L{KillRing}.
+    """
+
+    def test_empty(self):
+        """
+        An empty ring has nothing to yank.
+        """
+        ring = KillRing()
+        self.assertEqual(ring.yank(), None)
+        self.assertEqual(ring.rotate(), None)
+        self.assertEqual(ring.top(), None)
+
+
+    def test_kill(self):
+        """
+        The newest kill is yanked, with a piece for each cursor.
+        """
+        ring = KillRing()
+        ring.kill(["one"])
+        ring.kill(["two", "three"])
+        self.assertEqual(len(ring), 2)
+        self.assertEqual(ring.yank(), ["two", "three"])
+        self.assertEqual(ring.top(), "two\nthree")
+
+
+    def test_continueForward(self):
+        """
+        A kill made where the last one left off is added to the end of it.
+        """
+        ring = KillRing()
+        ring.kill(["one"], True, "before")
+        ring.continueAt("after")
+        ring.kill([" two"], True, "after")
+        self.assertEqual(len(ring), 1)
+        self.assertEqual(ring.yank(), ["one two"])
+
+
+    def test_continueBackward(self):
+        """
+        A backward kill made where the last one left off is added to the
+        beginning of it.
+        """
+        ring = KillRing()
+        ring.kill(["two"], False, "before")
+        ring.continueAt("after")
+        ring.kill(["one "], False, "after")
+        self.assertEqual(ring.yank(), ["one two"])
+
+
+    def test_continueEachCursor(self):
+        """
+        When several cursors continue a kill, each one's text is added to its
+        own piece.
+        """
+        ring = KillRing()
+        ring.kill(["a", "b"], True, 1)
+        ring.continueAt(2)
+        ring.kill(["c", "d"], True, 2)
+        self.assertEqual(ring.yank(), ["ac", "bd"])
+
+
+    def test_elsewhere(self):
+        """
+        A kill made anywhere other than where the last one left off starts a
+        new entry.
+        """
+        ring = KillRing()
+        ring.kill(["one"], True, 1)
+        ring.continueAt(2)
+        ring.kill(["two"], True, 3)
+        self.assertEqual(len(ring), 2)
+
+
+    def test_seal(self):
+        """
+        After L{KillRing.seal}, even a kill where the last one left off starts
+        a new entry.
+        """
+        ring = KillRing()
+        ring.kill(["one"], True, 1)
+        ring.continueAt(2)
+        ring.seal()
+        ring.kill(["two"], True, 2)
+        self.assertEqual(len(ring), 2)
+
+
+    def test_differentCursors(self):
+        """
+        A kill with a different number of cursors than the last one starts a
+        new entry.
+        """
+        ring = KillRing()
+        ring.kill(["one"], True, 1)
+        ring.continueAt(2)
+        ring.kill(["two", "three"], True, 2)
+        self.assertEqual(len(ring), 2)
+
+
+    def test_rotate(self):
+        """
+        L{KillRing.rotate} goes back through the entries, wrapping around from
+        the oldest to the newest, and L{KillRing.yank} starts again from the
+        newest.
+        """
+        ring = KillRing()
+        for text in ["one", "two", "three"]:
+            ring.kill([text])
+        self.assertEqual(ring.yank(), ["three"])
+        self.assertEqual([ring.rotate() for i in range(3)],
+                         [["two"], ["one"], ["three"]])
+        ring.rotate()
+        self.assertEqual(ring.yank(), ["three"])
+        self.assertEqual(ring.rotate(), ["two"])
+
+
+    def test_maxEntries(self):
+        """
+        Once the ring is full, the oldest entries are thrown away.
+        """
+        ring = KillRing(maxEntries=3)
+        for i in range(5):
+            ring.kill([unicode(i)])
+        self.assertEqual([kill.pieces() for kill in ring.entries],
+                         [["2"], ["3"], ["4"]])
+
+
+    def test_maxBytes(self):
+        """
+        Once the entries take more than C{maxBytes}, the oldest are thrown
+        away, but the newest is kept however big it is.
+        """
+        ring = KillRing(maxBytes=10)
+        ring.kill(["aaaa"])
+        ring.kill(["bbbb"])
+        self.assertEqual(len(ring), 2)
+        ring.kill(["cccc"])
+        self.assertEqual([kill.pieces() for kill in ring.entries],
+                         [["bbbb"], ["cccc"]])
+        ring.kill(["d" * 20])
+        self.assertEqual(len(ring), 1)
+        self.assertEqual(ring.size, 20)
+
+
+    def test_compressed(self):
+        """
+        Big entries are compressed, and give back the same text.
+        """
+        ring = KillRing(compressAbove=10)
+        text = "\N{SNOWMAN} and more" * 10
+        ring.kill([text, "short"])
+        self.assertTrue(ring.entries[-1].compressed)
+        self.assertTrue(ring.size < len(text))
+        self.assertEqual(ring.yank(), [text, "short"])
+
+
+
+class _DeferredThread(object):
+    """
+    Stand-in for L{threading.Thread} which doesn't run its target until told
+    to.
+    """
+
+    def __init__(self, target, args):
+        self.target = target
+        self.args = args
+        self.daemon = False
+
+
+    def start(self):
+        _DeferredThread.started.append(self)
+
+
+    def run(self):
+        self.target(*self.args)
+
+
+
+class KillLogTests(unittest.TestCase):
+    """
+    Tests for L{KillLog}, and L{KillRing.persist}.
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "kill-ring")
+        _DeferredThread.started = []
+        self.threadClass = threading.Thread
+        emax_kill_ring.threading.Thread = _DeferredThread
+
+
+    def tearDown(self):
+        emax_kill_ring.threading.Thread = self.threadClass
+        shutil.rmtree(self.directory)
+
+
+    def reloaded(self):
+        """
+        Load the log again, as a later session would.
+
+        @return: the text of each entry, oldest first.
+        """
+        ring = KillRing()
+        ring.persist(KillLog(self.path))
+        return [kill.pieces() for kill in ring.entries]
+
+
+    def test_noFile(self):
+        """
+        Loading a log that hasn't been written yet gives no entries.
+        """
+        self.assertEqual(KillLog(self.path).load(), [])
+
+
+    def test_persist(self):
+        """
+        Kills made after L{KillRing.persist}, and the ones already in the ring,
+        are loaded again in a later session; merged kills are loaded as they
+        ended up.
+        """
+        ring = KillRing()
+        ring.kill(["before"])
+        ring.persist(KillLog(self.path))
+        ring.kill(["one"], True, 1)
+        ring.continueAt(2)
+        ring.kill([" two"], True, 2)
+        ring.kill(["three", "\N{SNOWMAN}"])
+        self.assertEqual(self.reloaded(),
+                         [["before"], ["one two"], ["three", "\N{SNOWMAN}"]])
+
+
+    def test_truncated(self):
+        """
+        A record that was only partly written is cut off the end of the file,
+        so that the next one is written after the last complete one.
+        """
+        log = KillLog(self.path)
+        ring = KillRing()
+        ring.persist(log)
+        ring.kill(["one"])
+        complete = log.size
+        ring.kill(["two"])
+        with open(self.path, "r+b") as f:
+            f.truncate(log.size - 2)
+        log = KillLog(self.path)
+        self.assertEqual([kill.pieces() for kill in log.load()], [["one"]])
+        self.assertEqual(os.path.getsize(self.path), complete)
+        self.assertEqual((log.records, log.size), (1, complete))
+        ring = KillRing()
+        ring.persist(log)
+        ring.kill(["three"])
+        self.assertEqual(self.reloaded(), [["one"], ["three"]])
+
+
+    def test_compactWhileAppending(self):
+        """
+        When the log is rewritten, it holds the entries it was given and
+        anything appended while it was being rewritten.
+        """
+        log = KillLog(self.path)
+        ring = KillRing()
+        ring.persist(log)
+        for text in ["one", "two", "three"]:
+            ring.kill([text])
+        log.compact(ring.entries[1:])
+        ring.kill(["four"])
+        ring.kill(["five"])
+        # Only one rewrite at a time.
+        log.compact(ring.entries)
+        self.assertEqual(len(_DeferredThread.started), 1)
+        _DeferredThread.started[0].run()
+        self.assertEqual(self.reloaded(),
+                         [["two"], ["three"], ["four"], ["five"]])
+        self.assertEqual(log.records, 4)
+        self.assertEqual(log.size, os.path.getsize(self.path))
+        self.assertFalse(os.path.exists(self.path + ".new"))
+
+
+    def test_compactWhenBig(self):
+        """
+        The log is rewritten once it holds twice as many records as the ring
+        can.
+        """
+        log = KillLog(self.path)
+        ring = KillRing(maxEntries=2)
+        ring.persist(log)
+        for i in range(4):
+            ring.kill([unicode(i)])
+        self.assertEqual(_DeferredThread.started, [])
+        ring.kill(["4"])
+        _DeferredThread.started[0].run()
+        self.assertEqual(log.records, 2)
+        self.assertEqual(self.reloaded(), [["3"], ["4"]])
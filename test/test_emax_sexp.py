@@ -0,0 +1,139 @@
+# Copyright (C) 2012
+# See LICENSE.txt for details.
+
+"""
+Tests for L{emax_sexp}.
+"""
+
+from __future__ import unicode_literals
+
+import random
+import time
+import unittest
+
+from emax_sexp import SexpIndex, ScanTimeout
+
+
+
+def answers(index):
+    """
+    Ask an index every question about every point in its text.
+
+    @rtype: C{list}
+    """
+    return [(index.forward(point), index.backward(point), index.up(point),
+             index.down(point), index.matching(point))
+            for point in range(len(index.text) + 1)]
+
+
+
+class SexpIndexTests(unittest.TestCase):
+    """
+    Tests for L{SexpIndex}.
+    """
+
+    def test_brackets(self):
+        """
+        Brackets are moved over as a whole, and into and out of.
+        """
+        index = SexpIndex("(a [b] c) d")
+        self.assertEqual(index.forward(0), 9)
+        self.assertEqual(index.forward(3), 6)
+        self.assertEqual(index.backward(9), 0)
+        self.assertEqual(index.backward(6), 3)
+        self.assertEqual(index.up(4), 3)
+        self.assertEqual(index.down(0), 1)
+        self.assertEqual(index.matching(0), (0, 8))
+        self.assertEqual(index.matching(6), (3, 5))
+
+
+    def test_atoms(self):
+        """
+        Brackets in an atom are skipped over, and the atom is moved over as a
+        whole.
+        """
+        text = "(a # ) x\n b)"
+        self.assertEqual(SexpIndex(text).forward(0), 6)
+        index = SexpIndex(text, [(3, 8)])
+        self.assertEqual(index.forward(0), 12)
+        self.assertEqual(index.forward(3), 8)
+        self.assertEqual(index.backward(8), 3)
+
+
+    def test_atomBounds(self):
+        """
+        Atoms can be given as anything, along with a function to find their
+        bounds.
+        """
+        index = SexpIndex("(a # ) x\n b)", ["3-8"],
+                          lambda atom: map(int, atom.split("-")))
+        self.assertEqual(index.forward(0), 12)
+
+
+    def test_deadline(self):
+        """
+        Scanning gives up once the deadline has passed, and carries on from
+        where it got to once there's no deadline.
+        """
+        index = SexpIndex("(a)" * SexpIndex.scanBlock + "(")
+        index.deadline = time.time() - 1
+        self.assertRaises(ScanTimeout, index.forward, len(index.text) - 1)
+        index.deadline = None
+        self.assertEqual(index.up(len(index.text)), len(index.text) - 1)
+
+
+    def test_update(self):
+        """
+        After L{SexpIndex.update}, an index gives the same answers as one made
+        from scratch with the new text and atoms, however much of the old text
+        it had scanned.
+        """
+        rng = random.Random(14)
+        for i in range(300):
+            text = "".join(rng.choice("ab ([{}])'\"\\\n#")
+                           for j in range(rng.randint(0, 30)))
+            atoms = randomAtoms(rng, text, 0)
+            index = SexpIndex(text, atoms)
+            index.checkpointInterval = 4
+            for j in range(5):
+                index.forward(rng.randint(0, len(text)))
+                old = text
+                start = rng.randint(0, len(text))
+                end = rng.randint(start, min(len(text), start + 4))
+                text = (text[:start]
+                        + "".join(rng.choice("ab ([{}])'\"\\\n")
+                                  for k in range(rng.randint(0, 4)))
+                        + text[end:])
+                if text != old:
+                    # As a syntax highlighter would, keep the atoms before
+                    # the line where the text changed.
+                    change = 0
+                    while (change < min(len(old), len(text)) and
+                           old[change] == text[change]):
+                        change += 1
+                    line = text.rfind("\n", 0, change) + 1
+                    kept = [atom for atom in atoms if atom[1] < line]
+                    atoms = kept + randomAtoms(
+                        rng, text, max([line] + [b for (a, b) in kept]))
+                index.update(text, atoms)
+                self.assertEqual(answers(index),
+                                 answers(SexpIndex(text, atoms)),
+                                 (old, text, atoms))
+
+
+
+def randomAtoms(rng, text, start):
+    """
+    Pick some atoms that don't overlap in a text, after a given offset.
+
+    @rtype: C{list} of 2-C{tuple}s
+    """
+    atoms = []
+    at = start
+    while True:
+        at += rng.randint(0, 10)
+        if at >= len(text):
+            return atoms
+        end = min(len(text), at + rng.randint(1, 6))
+        atoms.append((at, end))
+        at = end